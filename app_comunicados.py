@@ -6,6 +6,12 @@ from datetime import datetime
 import sys
 import time
 from status_manager import StatusManager
+from whatsapp_groups import GROUP_FIELDS, GROUPS_FILE, load_group_map
+from personalization import TEMPLATE_EXTENSIONS
+from send_report import REPORTS_DIR
+from roster_store import (
+    ROSTER_COLUMNS, ROSTER_PATH, RosterIndex, import_roster, missing_columns, preview_roster, roster_version
+)
 import base64
 
 # Diretórios
@@ -22,25 +28,44 @@ os.makedirs(ENVIADOS_DIR, exist_ok=True)
 st.set_page_config(page_title="Envio de Comunicados", page_icon="📢")
 st.title("📢 Sistema de Envio de Comunicados")
 
-# Inicializar StatusManager
-status_manager = StatusManager("comunicados_status.json")
+# Inicializar StatusManager (compartilhado entre reruns para reaproveitar o snapshot do status)
+@st.cache_resource
+def get_status_manager():
+    return StatusManager("comunicados_status.json")
+
+status_manager = get_status_manager()
+
+# Planilha lida uma vez por versão, e não a cada rerun
+@st.cache_data(max_entries=2, show_spinner=False)
+def read_colaboradores(version):
+    """Lê a planilha de colaboradores (a versão é a chave do cache)"""
+    return pd.read_excel(ROSTER_PATH)
 
 # Função para carregar colaboradores
-def load_colaboradores():
-    """Carrega a planilha de colaboradores"""
-    colaboradores_file = os.path.join(COLABORADORES_DIR, "colaboradores.xlsx")
-    if os.path.exists(colaboradores_file):
+def load_colaboradores(version=None):
+    """
+    Carrega a planilha de colaboradores
+    version: versão já obtida com roster_version() (lida agora se omitida)
+    """
+    version = version or roster_version()
+    if version is not None:
         try:
-            return pd.read_excel(colaboradores_file)
+            return read_colaboradores(version)
         except Exception as e:
             st.error(f"Erro ao carregar colaboradores: {e}")
             return None
     return None
 
+# Índice de Setor/Obra, construído uma vez por versão da planilha
+@st.cache_resource(max_entries=2)
+def get_roster_index(version):
+    """Retorna o índice de grupos da planilha (a versão é a chave do cache)"""
+    return RosterIndex.build(ROSTER_PATH)
+
 # Função para salvar colaboradores
 def save_colaboradores(df):
     """Salva a planilha de colaboradores"""
-    colaboradores_file = os.path.join(COLABORADORES_DIR, "colaboradores.xlsx")
+    colaboradores_file = ROSTER_PATH
     try:
         df.to_excel(colaboradores_file, index=False)
         return True
@@ -75,7 +100,7 @@ if status["is_running"]:
         st.metric("Falhas", status['failed_sends'])
     
     # Barra de progresso
-    progress = status_manager.get_progress_percentage()
+    progress = StatusManager.progress_of(status)
     st.progress(progress / 100)
     st.text(f"Progresso: {progress:.1f}%")
     
@@ -109,6 +134,17 @@ else:
     else:
         st.info("ℹ️ **Nenhuma execução em andamento**")
 
+if status.get("skipped_sends"):
+    st.caption(f"⏭️ {status['skipped_sends']} colaborador(es) já haviam recebido este comunicado e foram pulados")
+
+# Confirmações de entrega/leitura recebidas pelo webhook_receiver.py
+if status.get("delivered_count") or status.get("read_count"):
+    col1, col2 = st.columns(2)
+    with col1:
+        st.metric("📬 Entregues", status.get('delivered_count', 0))
+    with col2:
+        st.metric("👀 Lidos", status.get('read_count', 0))
+
 st.markdown("---")
 
 # Seção de gerenciamento de colaboradores
@@ -119,30 +155,34 @@ tab1, tab2, tab3 = st.tabs(["📋 Visualizar Colaboradores", "➕ Adicionar", "
 
 with tab1:
     st.markdown("### Lista de Colaboradores")
-    df_colaboradores = load_colaboradores()
+    tab1_version = roster_version()
+    df_colaboradores = load_colaboradores(tab1_version)
     
     if df_colaboradores is not None and not df_colaboradores.empty:
+        roster_index = get_roster_index(tab1_version)
+        
         # Filtros
         col1, col2 = st.columns(2)
         with col1:
             setor_filter = st.selectbox(
                 "Filtrar por setor:",
-                ["Todos"] + list(df_colaboradores['Setor'].unique()),
+                ["Todos"] + roster_index.setores(),
                 key="setor_filter"
             )
         with col2:
             obra_filter = st.selectbox(
                 "Filtrar por obra:",
-                ["Todos"] + list(df_colaboradores['Obra'].unique()),
+                ["Todos"] + roster_index.obras(),
                 key="obra_filter"
             )
         
-        # Aplicar filtros
-        filtered_df = df_colaboradores.copy()
+        # Aplicar filtros pelo índice de grupos
+        filters = {}
         if setor_filter != "Todos":
-            filtered_df = filtered_df[filtered_df['Setor'] == setor_filter]
+            filters['setores'] = [setor_filter]
         if obra_filter != "Todos":
-            filtered_df = filtered_df[filtered_df['Obra'] == obra_filter]
+            filters['obras'] = [obra_filter]
+        filtered_df = df_colaboradores[df_colaboradores.index.isin(roster_index.select(filters))]
         
         st.dataframe(filtered_df, use_container_width=True)
         st.info(f"Total de colaboradores: {len(filtered_df)}")
@@ -198,28 +238,45 @@ with tab3:
     st.info("A planilha deve conter as colunas: Nome, Telefone, Setor, Obra")
     
     uploaded_file = st.file_uploader(
-        "📎 Enviar planilha Excel (.xlsx)",
-        type="xlsx",
+        "📎 Enviar planilha Excel (.xlsx) ou CSV",
+        type=["xlsx", "csv"],
         key="upload_colaboradores"
     )
     
     if uploaded_file:
         try:
-            df_uploaded = pd.read_excel(uploaded_file)
+            # Lê apenas o cabeçalho e uma amostra; a planilha completa é processada na importação
+            columns, sample_rows = preview_roster(uploaded_file, uploaded_file.name)
             
             # Verificar se tem as colunas necessárias
-            required_columns = ['Nome', 'Telefone', 'Setor', 'Obra']
-            if all(col in df_uploaded.columns for col in required_columns):
+            missing = missing_columns(columns)
+            if not missing:
                 st.success("✅ Planilha válida!")
-                st.dataframe(df_uploaded)
+                st.caption(f"Prévia das primeiras {len(sample_rows)} linhas")
+                st.dataframe(pd.DataFrame(sample_rows, columns=columns))
                 
                 if st.button("💾 Salvar Colaboradores"):
-                    if save_colaboradores(df_uploaded):
-                        st.success("Colaboradores salvos com sucesso!")
+                    progress_bar = st.progress(0.0, text="Importando colaboradores...")
+                    
+                    def show_import_progress(processed, total):
+                        if total:
+                            progress_bar.progress(min(processed / total, 1.0), text=f"{processed}/{total} linhas lidas")
+                        else:
+                            progress_bar.progress(0.0, text=f"{processed} linhas lidas")
+                    
+                    report = import_roster(uploaded_file, uploaded_file.name, progress_callback=show_import_progress)
+                    progress_bar.progress(1.0, text="Importação concluída")
+                    st.success(f"{report['imported']} colaboradores salvos com sucesso!")
+                    if report["invalid"]:
+                        st.warning(f"{report['invalid']} linha(s) ignorada(s) por dados inválidos")
+                        with st.expander("Ver linhas ignoradas"):
+                            for error in report["errors"]:
+                                st.text(error)
+                    else:
                         st.rerun()
             else:
-                st.error(f"A planilha deve conter as colunas: {', '.join(required_columns)}")
-                st.write("Colunas encontradas:", list(df_uploaded.columns))
+                st.error(f"A planilha deve conter as colunas: {', '.join(ROSTER_COLUMNS)}")
+                st.write("Colunas encontradas:", columns)
                 
         except Exception as e:
             st.error(f"Erro ao ler planilha: {e}")
@@ -260,17 +317,21 @@ if uploaded_comunicado:
 
 # Seleção de destinatários
 st.markdown("### 👥 Seleção de Destinatários")
-df_colaboradores = load_colaboradores()
+# Versão lida antes da planilha: se ela mudar depois, o envio recusa a seleção
+roster_loaded_version = roster_version()
+df_colaboradores = load_colaboradores(roster_loaded_version)
 
 if df_colaboradores is not None and not df_colaboradores.empty:
     # Opções de seleção
     selection_mode = st.radio(
         "Como deseja selecionar os destinatários?",
-        ["Selecionar individualmente", "Por setor", "Por obra", "Todos os colaboradores"],
+        ["Selecionar individualmente", "Por setor e/ou obra", "Todos os colaboradores"],
         key="selection_mode"
     )
     
     selected_colaboradores = pd.DataFrame()
+    # Seleção enviada ao script por referência à planilha (filtros ou linhas)
+    selection_spec = {}
     
     if selection_mode == "Selecionar individualmente":
         selected_names = st.multiselect(
@@ -279,22 +340,50 @@ if df_colaboradores is not None and not df_colaboradores.empty:
             key="individual_selection"
         )
         selected_colaboradores = df_colaboradores[df_colaboradores['Nome'].isin(selected_names)]
+        selection_spec = {'row_ids': [int(row_id) for row_id in selected_colaboradores.index]}
         
-    elif selection_mode == "Por setor":
-        selected_setores = st.multiselect(
-            "Selecione os setores:",
-            df_colaboradores['Setor'].unique().tolist(),
-            key="setor_selection"
-        )
-        selected_colaboradores = df_colaboradores[df_colaboradores['Setor'].isin(selected_setores)]
+    elif selection_mode == "Por setor e/ou obra":
+        roster_index = get_roster_index(roster_loaded_version)
+        col1, col2 = st.columns(2)
+        with col1:
+            selected_setores = st.multiselect(
+                "Selecione os setores:",
+                roster_index.setores(),
+                format_func=lambda setor: f"{setor or '(sem setor)'} ({len(roster_index.setor_rows[setor])})",
+                key="setor_selection"
+            )
+            excluded_setores = st.multiselect(
+                "Excluir setores:",
+                roster_index.setores(),
+                format_func=lambda setor: setor or '(sem setor)',
+                key="setor_exclusion"
+            )
+        with col2:
+            # Contagem por obra restrita aos setores já escolhidos
+            obra_counts = roster_index.obra_counts(selected_setores)
+            selected_obras = st.multiselect(
+                "Selecione as obras:",
+                roster_index.obras(),
+                format_func=lambda obra: f"{obra or '(sem obra)'} ({obra_counts.get(obra, 0)})",
+                key="obra_selection"
+            )
+            excluded_obras = st.multiselect(
+                "Excluir obras:",
+                roster_index.obras(),
+                format_func=lambda obra: obra or '(sem obra)',
+                key="obra_exclusion"
+            )
         
-    elif selection_mode == "Por obra":
-        selected_obras = st.multiselect(
-            "Selecione as obras:",
-            df_colaboradores['Obra'].unique().tolist(),
-            key="obra_selection"
-        )
-        selected_colaboradores = df_colaboradores[df_colaboradores['Obra'].isin(selected_obras)]
+        selection_spec = {
+            'setores': selected_setores,
+            'obras': selected_obras,
+            'excluir_setores': excluded_setores,
+            'excluir_obras': excluded_obras
+        }
+        # Sem nenhum filtro, nenhum colaborador é selecionado
+        if any(selection_spec.values()):
+            selected_rows = roster_index.select(selection_spec)
+            selected_colaboradores = df_colaboradores[df_colaboradores.index.isin(selected_rows)]
         
     elif selection_mode == "Todos os colaboradores":
         selected_colaboradores = df_colaboradores.copy()
@@ -319,30 +408,98 @@ mensagem_comunicado = st.text_area(
     key="mensagem_comunicado"
 )
 
+# Modo de entrega
+st.markdown("### 📨 Modo de Entrega")
+delivery_mode = st.radio(
+    "Como deseja entregar o comunicado?",
+    ["Individual (uma mensagem por colaborador)", "Grupo do WhatsApp por obra", "Grupo do WhatsApp por setor"],
+    key="delivery_mode"
+)
+group_kind = {
+    "Grupo do WhatsApp por obra": "obra",
+    "Grupo do WhatsApp por setor": "setor"
+}.get(delivery_mode)
+
+# Grupos com só parte dos colaboradores selecionada: o envio exige confirmação
+partial_groups = {}
+confirm_partial_groups = False
+if group_kind and df_colaboradores is not None and not selected_colaboradores.empty:
+    group_map = load_group_map()[group_kind]
+    # Nomes dos grupos pelo índice, com a mesma normalização usada pelo script de envio
+    roster_index = get_roster_index(roster_loaded_version)
+    selected_groups = sorted(roster_index.groups_of(group_kind, selected_colaboradores.index))
+    st.info(
+        f"O comunicado será enviado uma única vez para cada um dos {len(selected_groups)} grupo(s) do WhatsApp "
+        "e chegará a todos os participantes de cada grupo, não só aos colaboradores selecionados"
+    )
+    partial_groups = roster_index.partial_groups(group_kind, selected_colaboradores.index)
+    if partial_groups:
+        details = "\n".join(
+            f"- {GROUP_FIELDS[group_kind]} {name or '(vazio)'}: {selected} de {total} colaboradores selecionados"
+            for name, (selected, total) in sorted(partial_groups.items())
+        )
+        st.warning(f"⚠️ A seleção inclui só parte destes grupos. Os colaboradores não selecionados também receberão o comunicado:\n{details}")
+        confirm_partial_groups = st.checkbox(
+            "Confirmo o envio para os grupos inteiros",
+            key="confirm_partial_groups"
+        )
+    unmapped_groups = [group for group in selected_groups if group not in group_map]
+    if unmapped_groups:
+        st.warning(f"Sem grupo do WhatsApp mapeado em `{GROUPS_FILE}`: {', '.join(unmapped_groups)}")
+
+# Personalização da imagem por colaborador (apenas envio individual)
+personalize = False
+if comunicado_path and comunicado_path.lower().endswith(TEMPLATE_EXTENSIONS) and not group_kind:
+    personalize = st.checkbox(
+        "🖊️ Personalizar a imagem com nome, setor e obra de cada colaborador",
+        help="Cada colaborador recebe uma cópia da imagem com seus dados no rodapé",
+        key="personalize"
+    )
+
+force_resend = st.checkbox(
+    "🔁 Reenviar para quem já recebeu este comunicado",
+    help="Por padrão, colaboradores que já receberam a mesma mensagem e arquivo recentemente são pulados",
+    key="force_resend"
+)
+
+profile_run = st.checkbox(
+    "🔬 Gerar relatório de profiling da execução",
+    help="Registra tempos por etapa, cProfile e uso de memória num arquivo ao lado do log",
+    key="profile_run"
+)
+
 # Botão de envio
 if st.button(
     "📤 Enviar Comunicado via Evolution API", 
     key="btn_enviar_comunicado",
-    disabled=status_manager.is_running()
+    disabled=status["is_running"]
 ):
-    # Validações
+    # Validações (revalida pelo resumo, sem recarregar os dados por funcionário)
     if status_manager.is_running():
         st.error("❌ Já existe uma execução em andamento. Aguarde a conclusão.")
     elif not comunicado_path and not mensagem_comunicado.strip():
         st.error("❌ Digite uma mensagem ou faça upload de um arquivo para enviar.")
     elif df_colaboradores is None or selected_colaboradores.empty:
         st.error("❌ Nenhum colaborador foi selecionado.")
+    elif partial_groups and not confirm_partial_groups:
+        st.error("❌ A seleção inclui só parte dos grupos do WhatsApp. Selecione a obra/setor inteiro ou confirme o envio para os grupos inteiros.")
     else:
         # Salvar dados temporários para o script de envio
+        # Apenas a seleção é gravada; o script lê os colaboradores da planilha sob demanda
         temp_data = {
-            'colaboradores': selected_colaboradores.to_dict('records'),
+            'selecao': dict(selection_spec, roster_path=ROSTER_PATH, roster_version=roster_loaded_version),
             'comunicado_path': comunicado_path if comunicado_path and os.path.exists(comunicado_path) else None,
-            'mensagem': mensagem_comunicado.strip() if mensagem_comunicado.strip() else None
+            'mensagem': mensagem_comunicado.strip() if mensagem_comunicado.strip() else None,
+            'profile': profile_run,
+            'forcar_reenvio': force_resend,
+            'grupo': group_kind,
+            'grupo_parcial': confirm_partial_groups,
+            'personalizar': personalize
         }
         
         import json
         with open('temp_comunicado_data.json', 'w', encoding='utf-8') as f:
-            json.dump(temp_data, f, ensure_ascii=False, indent=2)
+            json.dump(temp_data, f, ensure_ascii=False)
         
         with st.status("📤 Enviando comunicado via API...", expanded=True) as status_widget:
             result = subprocess.run(
@@ -367,7 +524,7 @@ if status["employees_status"]:
     with col1:
         status_filter = st.selectbox(
             "Filtrar por status:",
-            ["Todos", "✅ Enviado", "❌ Falha", "🔄 Processando", "⏳ Aguardando"],
+            ["Todos", "✅ Enviado", "⏭️ Já recebido", "❌ Falha", "🔄 Processando", "🔁 Reenvio agendado", "⏳ Aguardando"],
             key="detailed_status_filter"
         )
     
@@ -380,7 +537,9 @@ if status["employees_status"]:
         status_emoji = {
             "success": "✅ Enviado",
             "failed": "❌ Falha", 
-            "processing": "🔄 Processando"
+            "processing": "🔄 Processando",
+            "retrying": "🔁 Reenvio agendado",
+            "skipped": "⏭️ Já recebido"
         }.get(emp_data["status"], "⏳ Aguardando")
         
         if status_filter != "Todos" and status_emoji != status_filter:
@@ -394,11 +553,27 @@ if status["employees_status"]:
             with col1:
                 st.write(f"**Status:** {emp_data['status']}")
                 st.write(f"**Mensagem:** {emp_data['message']}")
+                if emp_data.get('delivery'):
+                    st.write(f"**Confirmação:** {'Lido' if emp_data['delivery'] == 'read' else 'Entregue'}")
             with col2:
                 if emp_data.get('timestamp'):
                     timestamp = datetime.fromisoformat(emp_data['timestamp'])
                     st.write(f"**Última atualização:** {timestamp.strftime('%d/%m/%Y %H:%M:%S')}")
 
+# Relatórios de envio por colaborador (gerados ao fim de cada execução)
+with st.expander("📊 Relatórios de envio"):
+    reports = []
+    if os.path.exists(REPORTS_DIR):
+        reports = sorted(os.listdir(REPORTS_DIR), reverse=True)[:20]
+    
+    if reports:
+        # Só o relatório escolhido é lido, e não todos a cada rerun
+        selected_report = st.selectbox("Relatório:", reports, key="selected_report")
+        with open(os.path.join(REPORTS_DIR, selected_report), "rb") as f:
+            st.download_button(f"⬇️ Baixar {selected_report}", f.read(), file_name=selected_report, key="download_report")
+    else:
+        st.info("Nenhum relatório de envio gerado ainda.")
+
 # Visualizar arquivos enviados
 with st.expander("📄 Ver arquivos de comunicado enviados"):
     files = []
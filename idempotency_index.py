@@ -0,0 +1,91 @@
+import hashlib
+import json
+import os
+import threading
+from datetime import datetime, timedelta
+from typing import Optional
+
+
+class IdempotencyIndex:
+    """
+    Índice persistente de comunicados já entregues, por (telefone, conteúdo)
+    Evita reenviar o mesmo comunicado ao mesmo colaborador dentro da janela configurada.
+    O índice fica em memória (dict, busca O(1)) e é persistido num arquivo JSONL
+    em que cada entrega é acrescentada como uma linha.
+    """
+
+    def __init__(self, index_file: str = "comunicados_enviados.jsonl", window_hours: float = 72):
+        """
+        Args:
+            index_file: Arquivo do índice
+            window_hours: Janela em horas para considerar um envio repetido (0 desativa a verificação)
+        """
+        self.index_file = index_file
+        self.window = timedelta(hours=window_hours)
+        self.lock = threading.Lock()
+        self._entries = {}
+        self._load()
+
+    @staticmethod
+    def content_hash(mensagem: Optional[str], comunicado_path: Optional[str]) -> str:
+        """Hash do conteúdo do comunicado: mensagem + bytes do arquivo (se houver)"""
+        digest = hashlib.sha256()
+        digest.update((mensagem or "").strip().encode("utf-8"))
+        digest.update(b"\0")
+        if comunicado_path and os.path.exists(comunicado_path):
+            with open(comunicado_path, "rb") as f:
+                for block in iter(lambda: f.read(1024 * 1024), b""):
+                    digest.update(block)
+        return digest.hexdigest()
+
+    def _load(self):
+        """Carrega o índice, descartando entregas fora da janela"""
+        if not os.path.exists(self.index_file):
+            return
+
+        cutoff = datetime.now() - self.window
+        total_lines = 0
+        with open(self.index_file, "r", encoding="utf-8") as f:
+            for line in f:
+                total_lines += 1
+                try:
+                    entry = json.loads(line)
+                    sent_at = datetime.fromisoformat(entry["sent_at"])
+                except (json.JSONDecodeError, KeyError, ValueError):
+                    continue
+                if sent_at >= cutoff:
+                    self._entries[entry["key"]] = entry["sent_at"]
+
+        # Compacta o arquivo quando a maior parte das linhas já expirou
+        if total_lines > 1000 and len(self._entries) < total_lines / 2:
+            self._compact()
+
+    def _compact(self):
+        """Regrava o arquivo apenas com as entregas dentro da janela"""
+        temp_file = self.index_file + ".tmp"
+        with open(temp_file, "w", encoding="utf-8") as f:
+            for key, sent_at in self._entries.items():
+                f.write(json.dumps({"key": key, "sent_at": sent_at}) + "\n")
+        os.replace(temp_file, self.index_file)
+
+    @staticmethod
+    def _key(phone: str, content_hash: str) -> str:
+        return f"{phone}:{content_hash}"
+
+    def delivered_at(self, phone: str, content_hash: str) -> Optional[str]:
+        """Retorna quando o conteúdo foi entregue ao telefone dentro da janela, ou None"""
+        if not self.window:
+            return None
+        sent_at = self._entries.get(self._key(phone, content_hash))
+        if sent_at and datetime.fromisoformat(sent_at) >= datetime.now() - self.window:
+            return sent_at
+        return None
+
+    def record(self, phone: str, content_hash: str):
+        """Registra a entrega do conteúdo ao telefone"""
+        key = self._key(phone, content_hash)
+        sent_at = datetime.now().isoformat()
+        with self.lock:
+            self._entries[key] = sent_at
+            with open(self.index_file, "a", encoding="utf-8") as f:
+                f.write(json.dumps({"key": key, "sent_at": sent_at}) + "\n")
@@ -0,0 +1,107 @@
+import logging
+import threading
+from typing import Callable, Optional
+
+# Classes de erro que indicam problema na instância (e não no colaborador) e contam para o disjuntor
+INSTANCE_ERROR_CLASSES = ("timeout", "5xx", "network")
+
+
+class CircuitBreaker:
+    """
+    Disjuntor de envio: abre quando a instância desconecta ou quando há
+    falhas consecutivas demais, pausando os envios até ser fechado novamente
+    """
+
+    def __init__(self, failure_threshold: int = 5):
+        self.failure_threshold = failure_threshold
+        self.consecutive_failures = 0
+        self.reason = None
+        self._closed = threading.Event()
+        self._closed.set()
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self) -> bool:
+        return not self._closed.is_set()
+
+    def trip(self, reason: str):
+        """Abre o disjuntor"""
+        with self._lock:
+            if not self.is_open:
+                logging.warning(f"Disjuntor aberto: {reason}. Envios pausados.")
+            self.reason = reason
+            self._closed.clear()
+
+    def reset(self):
+        """Fecha o disjuntor e libera os envios"""
+        with self._lock:
+            if self.is_open:
+                logging.info("Disjuntor fechado. Retomando envios.")
+            self.consecutive_failures = 0
+            self.reason = None
+            self._closed.set()
+
+    def record_success(self):
+        with self._lock:
+            self.consecutive_failures = 0
+
+    def record_failure(self, error_class: str):
+        """
+        Registra uma falha de envio e abre o disjuntor ao atingir o limite
+        Falhas do próprio colaborador (número inválido, arquivo grande demais) e
+        rate limit não são contadas (ver INSTANCE_ERROR_CLASSES)
+        """
+        if error_class not in INSTANCE_ERROR_CLASSES:
+            return
+        with self._lock:
+            self.consecutive_failures += 1
+            failures = self.consecutive_failures
+        if failures >= self.failure_threshold:
+            self.trip(f"{failures} falhas consecutivas")
+
+    def wait_until_closed(self, timeout: Optional[float] = None) -> bool:
+        """Bloqueia enquanto o disjuntor estiver aberto. Retorna False se o timeout expirar"""
+        return self._closed.wait(timeout)
+
+
+class InstanceHealthMonitor(threading.Thread):
+    """
+    Verifica periodicamente a conexão da instância durante a execução
+    Abre o disjuntor quando a instância desconecta e o fecha quando ela
+    volta a reportar 'open'/'connected'
+    """
+
+    def __init__(self, probe: Callable[[], bool], breaker: CircuitBreaker,
+                 interval: float = 30):
+        """
+        Args:
+            probe: Função que retorna True se a instância está conectada
+            breaker: Disjuntor controlado pelo monitor
+            interval: Intervalo entre verificações em segundos
+        """
+        super().__init__(daemon=True)
+        self.probe = probe
+        self.breaker = breaker
+        self.interval = interval
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            try:
+                connected = self.probe()
+            except Exception as e:
+                logging.error(f"Erro no monitor de saúde da instância: {e}")
+                connected = False
+
+            if not connected:
+                self.breaker.trip("Instância desconectada")
+            elif self.breaker.is_open:
+                self.breaker.reset()
+
+            # Verifica com mais frequência enquanto os envios estão pausados
+            interval = self.interval / 3 if self.breaker.is_open else self.interval
+            self._stop_event.wait(interval)
+
+    def stop(self):
+        """Encerra o monitor"""
+        self._stop_event.set()
@@ -0,0 +1,143 @@
+import hashlib
+import logging
+import os
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from itertools import islice
+from typing import Dict, Iterable, Iterator, Optional, Tuple
+from PIL import Image, ImageDraw, ImageFont
+
+# Cache dos comunicados personalizados, por (hash do modelo, dados do colaborador)
+# Só as imagens do modelo em uso são mantidas (ver PersonalizationPipeline.prune_cache)
+PERSONALIZED_DIR = "personalizados_cache"
+
+# Formatos de modelo suportados (o Pillow não edita PDFs)
+TEMPLATE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+
+
+def file_hash(path: str) -> str:
+    """Hash SHA-256 do conteúdo de um arquivo"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _load_font(size: int):
+    try:
+        return ImageFont.truetype("DejaVuSans.ttf", size)
+    except OSError:
+        return ImageFont.load_default()
+
+
+def render_variant(template_path: str, fields: Dict[str, str], output_path: str) -> str:
+    """
+    Gera o comunicado personalizado: adiciona uma faixa no rodapé da imagem
+    com o nome, setor e obra do colaborador
+    Executada nos processos do pool, por isso é uma função de módulo
+    """
+    with Image.open(template_path) as template:
+        image = template.convert("RGB")
+
+    font_size = max(14, image.width // 40)
+    font = _load_font(font_size)
+    lines = [
+        fields["Nome"],
+        f"Setor: {fields['Setor']}  |  Obra: {fields['Obra']}",
+    ]
+    line_height = int(font_size * 1.4)
+    band_height = line_height * len(lines) + font_size
+
+    personalized = Image.new("RGB", (image.width, image.height + band_height), "white")
+    personalized.paste(image, (0, 0))
+    draw = ImageDraw.Draw(personalized)
+    for index, line in enumerate(lines):
+        draw.text((font_size, image.height + font_size // 2 + index * line_height), line, fill="black", font=font)
+
+    # Grava em arquivo temporário para nunca expor uma imagem incompleta no cache
+    temp_path = f"{output_path}.{os.getpid()}.tmp{os.path.splitext(output_path)[1]}"
+    personalized.save(temp_path)
+    os.replace(temp_path, output_path)
+    return output_path
+
+
+class PersonalizationPipeline:
+    """
+    Gera os comunicados personalizados num pool de processos, mantendo no máximo
+    'lookahead' colaboradores à frente do envio. Percorrer o pipeline retorna
+    (colaborador, caminho do comunicado personalizado ou None em caso de erro),
+    na mesma ordem dos colaboradores.
+    """
+
+    def __init__(self, template_path: str, colaboradores: Iterable[Dict], lookahead: int = 4,
+                 workers: Optional[int] = None, cache_dir: str = PERSONALIZED_DIR):
+        if not template_path.lower().endswith(TEMPLATE_EXTENSIONS):
+            raise ValueError(f"Personalização disponível apenas para imagens ({', '.join(TEMPLATE_EXTENSIONS)})")
+        self.template_path = template_path
+        self.colaboradores = colaboradores
+        self.lookahead = lookahead
+        self.workers = workers
+        self.cache_dir = cache_dir
+        self.template_hash = file_hash(template_path)
+        os.makedirs(cache_dir, exist_ok=True)
+        self.prune_cache()
+
+    @property
+    def cache_prefix(self) -> str:
+        """Prefixo dos arquivos do modelo atual no cache"""
+        return self.template_hash[:16] + "_"
+
+    def prune_cache(self) -> int:
+        """
+        Remove do cache as imagens de outros modelos (comunicados anteriores)
+        e temporários abandonados. Retorna quantos arquivos foram removidos
+        """
+        removed = 0
+        for entry in os.scandir(self.cache_dir):
+            if not entry.is_file() or (entry.name.startswith(self.cache_prefix) and ".tmp" not in entry.name):
+                continue
+            try:
+                os.remove(entry.path)
+                removed += 1
+            except OSError as e:
+                logging.warning(f"Não foi possível remover {entry.path} do cache: {e}")
+        if removed:
+            logging.info(f"{removed} comunicado(s) personalizado(s) de modelos anteriores removido(s) do cache")
+        return removed
+
+    def cache_path(self, fields: Dict[str, str]) -> str:
+        """Caminho do comunicado personalizado no cache"""
+        key = "\0".join([self.template_hash, fields["Nome"], fields["Setor"], fields["Obra"]])
+        extension = os.path.splitext(self.template_path)[1].lower()
+        return os.path.join(self.cache_dir, self.cache_prefix + hashlib.sha256(key.encode("utf-8")).hexdigest() + extension)
+
+    def _submit(self, pool, colaborador: Dict) -> Tuple[Dict, Future]:
+        fields = {
+            "Nome": str(colaborador.get("Nome") or "").strip(),
+            "Setor": str(colaborador.get("Setor") or "").strip(),
+            "Obra": str(colaborador.get("Obra") or "").strip(),
+        }
+        output_path = self.cache_path(fields)
+        if os.path.exists(output_path):
+            future = Future()
+            future.set_result(output_path)
+            return colaborador, future
+        return colaborador, pool.submit(render_variant, self.template_path, fields, output_path)
+
+    def __iter__(self) -> Iterator[Tuple[Dict, Optional[str]]]:
+        source = iter(self.colaboradores)
+        with ProcessPoolExecutor(max_workers=self.workers) as pool:
+            pending = deque(self._submit(pool, colaborador) for colaborador in islice(source, self.lookahead))
+            while pending:
+                colaborador, future = pending.popleft()
+                # Repõe a janela antes de esperar, para o pool continuar à frente do envio
+                for next_colaborador in islice(source, 1):
+                    pending.append(self._submit(pool, next_colaborador))
+                try:
+                    output_path = future.result()
+                except Exception as e:
+                    logging.error(f"Erro ao personalizar comunicado para {colaborador.get('Nome')}: {e}")
+                    output_path = None
+                yield colaborador, output_path
+
@@ -0,0 +1,137 @@
+import heapq
+import itertools
+import os
+import random
+import time
+from typing import Dict, List, Optional
+
+
+class RetryPolicy:
+    """Política de reenvio para uma classe de erro"""
+
+    def __init__(self, max_attempts: int = 3, base_delay: float = 30,
+                 max_delay: float = 600, jitter: float = 0.5):
+        """
+        Args:
+            max_attempts: Número máximo de tentativas (incluindo a primeira)
+            base_delay: Espera base em segundos antes da primeira repetição
+            max_delay: Limite superior da espera em segundos
+            jitter: Fração aleatória aplicada sobre a espera (0 a 1)
+        """
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+
+    def backoff(self, attempt: int) -> float:
+        """
+        Calcula a espera antes da próxima tentativa (backoff exponencial com jitter)
+        attempt: número de tentativas já realizadas (1 após a primeira falha)
+        """
+        delay = min(self.max_delay, self.base_delay * (2 ** (attempt - 1)))
+        variation = delay * self.jitter
+        return max(0.0, delay + random.uniform(-variation, variation))
+
+
+# Políticas padrão por classe de erro
+# 'timeout': tempo de resposta esgotado
+# '5xx': erro do servidor da Evolution API
+# '429': rate limit atingido
+# 'network': falha de conexão ou outro erro de requisição
+DEFAULT_RETRY_POLICIES = {
+    "timeout": RetryPolicy(max_attempts=3, base_delay=20, max_delay=300),
+    "5xx": RetryPolicy(max_attempts=3, base_delay=60, max_delay=600),
+    "429": RetryPolicy(max_attempts=4, base_delay=120, max_delay=900),
+    "network": RetryPolicy(max_attempts=3, base_delay=30, max_delay=300),
+}
+
+
+class RetryEntry:
+    """Colaborador aguardando reenvio"""
+
+    def __init__(self, colaborador: Dict, pending_steps: List[str], attempt: int,
+                 error_class: str, due_time: float, comunicado_path: Optional[str] = None):
+        self.colaborador = colaborador
+        # Comunicado do colaborador (difere do original quando personalizado)
+        self.comunicado_path = comunicado_path
+        self.pending_steps = pending_steps
+        self.attempt = attempt
+        self.error_class = error_class
+        self.due_time = due_time
+
+
+class RetryQueue:
+    """
+    Fila de reenvios adiados, ordenada pelo horário em que cada reenvio vence.
+    Permite que a passagem principal continue com os demais colaboradores
+    enquanto as falhas aguardam o backoff.
+    """
+
+    def __init__(self, policies: Optional[Dict[str, RetryPolicy]] = None):
+        self.policies = dict(DEFAULT_RETRY_POLICIES)
+        if policies:
+            self.policies.update(policies)
+        self._heap = []
+        self._counter = itertools.count()
+
+    def __len__(self):
+        return len(self._heap)
+
+    def schedule(self, colaborador: Dict, pending_steps: List[str], attempt: int,
+                 error_class: str, comunicado_path: Optional[str] = None) -> Optional[RetryEntry]:
+        """
+        Agenda um reenvio para o colaborador
+        Retorna None se a classe de erro não permite reenvio ou as tentativas acabaram
+        """
+        policy = self.policies.get(error_class)
+        if policy is None or attempt >= policy.max_attempts:
+            return None
+
+        due_time = time.monotonic() + policy.backoff(attempt)
+        entry = RetryEntry(colaborador, pending_steps, attempt, error_class, due_time, comunicado_path)
+        heapq.heappush(self._heap, (due_time, next(self._counter), entry))
+        return entry
+
+    def requeue(self, colaborador: Dict, pending_steps: List[str], attempt: int,
+                error_class: str, comunicado_path: Optional[str] = None) -> RetryEntry:
+        """Reagenda para execução imediata sem consumir tentativa nem aplicar política"""
+        due_time = time.monotonic()
+        entry = RetryEntry(colaborador, pending_steps, attempt, error_class, due_time, comunicado_path)
+        heapq.heappush(self._heap, (due_time, next(self._counter), entry))
+        return entry
+
+    def pop_due(self) -> Optional[RetryEntry]:
+        """Retorna o próximo reenvio vencido, ou None se nenhum estiver vencido"""
+        if self._heap and self._heap[0][0] <= time.monotonic():
+            return heapq.heappop(self._heap)[2]
+        return None
+
+    def seconds_until_next(self) -> Optional[float]:
+        """Segundos até o próximo reenvio vencer (None se a fila estiver vazia)"""
+        if not self._heap:
+            return None
+        return max(0.0, self._heap[0][0] - time.monotonic())
+
+    def drain(self) -> List[RetryEntry]:
+        """Remove e retorna todos os reenvios pendentes"""
+        entries = [item[2] for item in sorted(self._heap)]
+        self._heap = []
+        return entries
+
+
+def load_retry_policies_from_env() -> Dict[str, RetryPolicy]:
+    """
+    Carrega ajustes das políticas de reenvio a partir de variáveis de ambiente
+    Formato: RETRY_<CLASSE>_MAX_ATTEMPTS, RETRY_<CLASSE>_BASE_DELAY, RETRY_<CLASSE>_MAX_DELAY
+    Ex: RETRY_429_BASE_DELAY=180, RETRY_TIMEOUT_MAX_ATTEMPTS=5
+    """
+    policies = {}
+    for error_class, default in DEFAULT_RETRY_POLICIES.items():
+        prefix = f"RETRY_{error_class.upper()}_"
+        policies[error_class] = RetryPolicy(
+            max_attempts=int(os.getenv(prefix + "MAX_ATTEMPTS", default.max_attempts)),
+            base_delay=float(os.getenv(prefix + "BASE_DELAY", default.base_delay)),
+            max_delay=float(os.getenv(prefix + "MAX_DELAY", default.max_delay)),
+            jitter=default.jitter
+        )
+    return policies
@@ -0,0 +1,357 @@
+import codecs
+import csv
+import logging
+import os
+from itertools import islice
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+from openpyxl import Workbook, load_workbook
+
+# Planilha de colaboradores usada pelo app e pelo script de envio
+COLABORADORES_DIR = "colaboradores"
+ROSTER_PATH = os.path.join(COLABORADORES_DIR, "colaboradores.xlsx")
+ROSTER_COLUMNS = ["Nome", "Telefone", "Setor", "Obra"]
+
+
+def _rewind(source):
+    """Volta ao início de arquivos já lidos (ex: UploadedFile do Streamlit)"""
+    if hasattr(source, "seek"):
+        source.seek(0)
+
+
+# Codificações tentadas nos .csv, em ordem. O "CSV (separado por ;)" do Excel
+# em português é gravado em cp1252; latin-1 aceita qualquer byte e fica por último
+CSV_ENCODINGS = ("utf-8-sig", "cp1252", "latin-1")
+
+
+def _detect_encoding(sample: bytes) -> str:
+    """Escolhe a primeira codificação de CSV_ENCODINGS que decodifica a amostra"""
+    for encoding in CSV_ENCODINGS:
+        try:
+            # final=False: a amostra pode terminar no meio de um caractere UTF-8
+            codecs.getincrementaldecoder(encoding)().decode(sample, final=False)
+            return encoding
+        except UnicodeDecodeError:
+            continue
+    return CSV_ENCODINGS[-1]
+
+
+def _csv_rows(source) -> Iterator[tuple]:
+    """Lê um .csv linha a linha, detectando a codificação e o separador (',', ';' ou tabulação)"""
+    binary = open(source, "rb") if isinstance(source, str) else source
+    try:
+        raw_sample = binary.read(64 * 1024)
+        binary.seek(0)
+        encoding = _detect_encoding(raw_sample)
+        sample = raw_sample[:4096].decode(encoding, errors="ignore")
+        try:
+            dialect = csv.Sniffer().sniff(sample, delimiters=",;\t")
+        except csv.Error:
+            dialect = csv.excel
+        for row in csv.reader(codecs.iterdecode(binary, encoding), dialect):
+            yield tuple(row)
+    finally:
+        if binary is not source:
+            binary.close()
+
+
+def _xlsx_rows(source) -> Iterator[tuple]:
+    """Lê um .xlsx linha a linha no modo read-only do openpyxl"""
+    workbook = load_workbook(source, read_only=True, data_only=True)
+    try:
+        yield from workbook.active.iter_rows(values_only=True)
+    finally:
+        workbook.close()
+
+
+def _iter_raw_rows(source, filename: str) -> Tuple[List[str], Iterator[tuple], Optional[int]]:
+    """
+    Abre uma planilha .xlsx ou .csv para leitura linha a linha
+    Retorna (cabeçalho, iterador de linhas, total estimado de linhas ou None)
+    """
+    _rewind(source)
+    total = None
+    if filename.lower().endswith(".csv"):
+        rows = _csv_rows(source)
+    else:
+        rows = _xlsx_rows(source)
+        # Estimativa a partir das dimensões gravadas na planilha (pode não existir)
+        try:
+            workbook = load_workbook(source, read_only=True)
+            max_row = workbook.active.max_row
+            workbook.close()
+            total = max_row - 1 if max_row else None
+        except Exception:
+            total = None
+        _rewind(source)
+    header = next(rows, ())
+    return [str(col).strip() if col is not None else "" for col in header], rows, total
+
+
+def clean_cell(value) -> str:
+    """
+    Converte o valor de uma célula para texto, sem o '.0' de números lidos do Excel
+    Células vazias (None, ou NaN quando lidas pelo pandas) viram ""
+    Usada em todo lugar que compara Setor/Obra (índice, seleção, grupos do WhatsApp)
+    """
+    if value is None or (isinstance(value, float) and value != value):
+        return ""
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return str(value).strip()
+
+
+def normalize_row(row: Dict) -> Tuple[Optional[Dict], Optional[str]]:
+    """
+    Valida e normaliza uma linha da planilha
+    Retorna (registro, None) se válida ou (None, motivo) se inválida
+    """
+    record = {
+        "Nome": clean_cell(row.get("Nome")),
+        "Telefone": clean_cell(row.get("Telefone")),
+        "Setor": clean_cell(row.get("Setor")),
+        "Obra": clean_cell(row.get("Obra")),
+    }
+    if not record["Nome"]:
+        return None, "Nome vazio"
+    if not any(char.isdigit() for char in record["Telefone"]):
+        return None, f"Telefone inválido para {record['Nome']}"
+    return record, None
+
+
+def missing_columns(header: List[str]) -> List[str]:
+    """Retorna as colunas obrigatórias ausentes no cabeçalho"""
+    return [col for col in ROSTER_COLUMNS if col not in header]
+
+
+def preview_roster(source, filename: str, limit: int = 20) -> Tuple[List[str], List[tuple]]:
+    """Lê apenas o cabeçalho e as primeiras linhas da planilha para a prévia"""
+    header, rows, _ = _iter_raw_rows(source, filename)
+    return header, list(islice(rows, limit))
+
+
+def import_roster(source, filename: str, dest: str = ROSTER_PATH, chunk_size: int = 1000,
+                  progress_callback: Optional[Callable[[int, Optional[int]], None]] = None) -> Dict:
+    """
+    Importa uma planilha .xlsx ou .csv para a planilha de colaboradores
+    As linhas são lidas, validadas e gravadas em blocos, sem carregar o arquivo
+    inteiro em memória. O arquivo de destino só é substituído ao final da importação.
+
+    Args:
+        source: Caminho ou arquivo aberto (ex: UploadedFile do Streamlit)
+        filename: Nome do arquivo, usado para identificar o formato
+        dest: Planilha de colaboradores de destino
+        chunk_size: Quantidade de linhas processadas por bloco
+        progress_callback: Função chamada a cada bloco com (linhas lidas, total estimado ou None)
+
+    Returns:
+        Dict com 'imported', 'invalid' e 'errors' (primeiros motivos de rejeição)
+    """
+    header, rows, total = _iter_raw_rows(source, filename)
+    missing = missing_columns(header)
+    if missing:
+        raise ValueError(f"A planilha deve conter as colunas: {', '.join(missing)}")
+
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet()
+    sheet.append(ROSTER_COLUMNS)
+
+    report = {"imported": 0, "invalid": 0, "errors": []}
+    processed = 0
+    try:
+        while True:
+            chunk = list(islice(rows, chunk_size))
+            if not chunk:
+                break
+            for raw in chunk:
+                processed += 1
+                if all(value is None or str(value).strip() == "" for value in raw):
+                    continue
+                record, error = normalize_row(dict(zip(header, raw)))
+                if error:
+                    report["invalid"] += 1
+                    if len(report["errors"]) < 50:
+                        report["errors"].append(f"Linha {processed + 1}: {error}")
+                    continue
+                sheet.append([record[col] for col in ROSTER_COLUMNS])
+                report["imported"] += 1
+            if progress_callback:
+                progress_callback(processed, total)
+    except BaseException:
+        # Descarta a planilha parcial; a de destino continua intacta
+        rows.close()
+        try:
+            sheet.close()
+        except Exception:
+            pass
+        raise
+
+    os.makedirs(os.path.dirname(dest) or ".", exist_ok=True)
+    temp_path = dest + ".tmp.xlsx"
+    workbook.save(temp_path)
+    os.replace(temp_path, dest)
+    return report
+
+
+def iter_roster(path: str = ROSTER_PATH) -> Iterator[Tuple[int, Dict]]:
+    """
+    Percorre a planilha de colaboradores linha a linha
+    Retorna (row_id, registro normalizado), onde row_id é a posição da linha entre os dados
+    (0 para a primeira linha após o cabeçalho, como o índice do pandas)
+    Linhas inválidas (ver normalize_row) são ignoradas com o motivo no log.
+    Levanta ValueError se faltarem colunas obrigatórias.
+    """
+    header, rows, _ = _iter_raw_rows(path, path)
+    missing = missing_columns(header)
+    if missing:
+        rows.close()
+        raise ValueError(f"A planilha {path} deve conter as colunas: {', '.join(missing)}")
+
+    for row_id, raw in enumerate(rows):
+        if all(value is None or str(value).strip() == "" for value in raw):
+            continue
+        record, error = normalize_row(dict(zip(header, raw)))
+        if error:
+            logging.warning(f"Linha {row_id + 2} da planilha ignorada: {error}")
+            continue
+        yield row_id, record
+
+
+def roster_version(path: str = ROSTER_PATH) -> Optional[str]:
+    """Versão da planilha (mtime e tamanho), usada para detectar alterações após a seleção"""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return f"{stat.st_mtime_ns}-{stat.st_size}"
+
+
+def matches_selection(row_id: int, record: Dict, selection: Dict) -> bool:
+    """
+    Verifica se o colaborador faz parte da seleção
+    selection: {'row_ids': [...]} para seleção individual, ou filtros
+    {'setores': [...], 'obras': [...], 'excluir_setores': [...], 'excluir_obras': [...]}
+    (lista vazia ou ausente = sem filtro)
+    """
+    row_ids = selection.get("row_ids")
+    if row_ids is not None:
+        return row_id in row_ids
+    setor = clean_cell(record.get("Setor"))
+    obra = clean_cell(record.get("Obra"))
+    setores = selection.get("setores")
+    if setores and setor not in setores:
+        return False
+    obras = selection.get("obras")
+    if obras and obra not in obras:
+        return False
+    if setor in selection.get("excluir_setores", ()) or obra in selection.get("excluir_obras", ()):
+        return False
+    return True
+
+
+class RosterIndex:
+    """
+    Índice dos colaboradores por Setor e por Obra, construído uma vez por versão da planilha
+    Cada grupo guarda o conjunto de row_ids, então combinar ou excluir filtros
+    são operações de conjunto, sem percorrer a planilha novamente
+    """
+
+    def __init__(self):
+        self.all_rows = set()
+        self.setor_rows = {}
+        self.obra_rows = {}
+        # (setor, obra) -> quantidade de colaboradores
+        self.pair_counts = {}
+
+    @classmethod
+    def build(cls, path: str = ROSTER_PATH) -> "RosterIndex":
+        """Constrói o índice percorrendo a planilha uma única vez"""
+        index = cls()
+        for row_id, record in iter_roster(path):
+            setor = clean_cell(record.get("Setor"))
+            obra = clean_cell(record.get("Obra"))
+            index.all_rows.add(row_id)
+            index.setor_rows.setdefault(setor, set()).add(row_id)
+            index.obra_rows.setdefault(obra, set()).add(row_id)
+            index.pair_counts[(setor, obra)] = index.pair_counts.get((setor, obra), 0) + 1
+        return index
+
+    def group_rows(self, group_kind: str) -> Dict[str, set]:
+        """row_ids por nome de grupo: 'obra' ou 'setor' (ver whatsapp_groups.GROUP_FIELDS)"""
+        return self.obra_rows if group_kind == "obra" else self.setor_rows
+
+    def groups_of(self, group_kind: str, rows: Iterable[int]) -> Dict[str, set]:
+        """Grupos ('obra' ou 'setor') que contêm alguma das linhas, com as linhas de cada um"""
+        rows = set(rows)
+        return {
+            name: group & rows
+            for name, group in self.group_rows(group_kind).items()
+            if not group.isdisjoint(rows)
+        }
+
+    def partial_groups(self, group_kind: str, rows: Iterable[int]) -> Dict[str, Tuple[int, int]]:
+        """
+        Grupos em que só parte dos colaboradores da planilha está entre as linhas informadas
+        Retorna {nome do grupo: (selecionados, total na planilha)}
+        """
+        groups = self.group_rows(group_kind)
+        return {
+            name: (len(selected), len(groups[name]))
+            for name, selected in self.groups_of(group_kind, rows).items()
+            if len(selected) < len(groups[name])
+        }
+
+    def selection_rows(self, selection: Dict) -> set:
+        """Linhas de uma seleção no formato de matches_selection (individual ou por filtros)"""
+        if selection.get("row_ids") is not None:
+            return set(selection["row_ids"]) & self.all_rows
+        return self.select(selection)
+
+    def setores(self) -> List[str]:
+        return sorted(self.setor_rows)
+
+    def obras(self) -> List[str]:
+        return sorted(self.obra_rows)
+
+    def _union(self, groups: Dict[str, set], names: Iterable[str]) -> set:
+        rows = set()
+        for name in names:
+            rows |= groups.get(name, set())
+        return rows
+
+    def select(self, selection: Dict) -> set:
+        """Retorna os row_ids que atendem aos filtros da seleção (mesmo formato de matches_selection)"""
+        rows = self.all_rows
+        if selection.get("setores"):
+            rows = rows & self._union(self.setor_rows, selection["setores"])
+        if selection.get("obras"):
+            rows = rows & self._union(self.obra_rows, selection["obras"])
+        excluded = self._union(self.setor_rows, selection.get("excluir_setores", ()))
+        excluded |= self._union(self.obra_rows, selection.get("excluir_obras", ()))
+        return rows - excluded
+
+    def obra_counts(self, setores: Optional[Iterable[str]] = None) -> Dict[str, int]:
+        """Quantidade de colaboradores por obra, restrita aos setores informados"""
+        setores = set(setores or ())
+        counts = {}
+        for (setor, obra), count in self.pair_counts.items():
+            if not setores or setor in setores:
+                counts[obra] = counts.get(obra, 0) + count
+        return counts
+
+
+def iter_selection(selection: Dict, path: Optional[str] = None) -> Iterator[Dict]:
+    """
+    Percorre sob demanda os colaboradores da seleção
+    Se a seleção trouxer 'roster_version', verifica antes se a planilha não mudou
+    """
+    path = path or selection.get("roster_path") or ROSTER_PATH
+    expected_version = selection.get("roster_version")
+    if expected_version and roster_version(path) != expected_version:
+        raise ValueError("A planilha de colaboradores foi alterada após a seleção dos destinatários. Refaça a seleção.")
+
+    # Conjunto para busca O(1) por linha na seleção individual
+    if selection.get("row_ids") is not None:
+        selection = dict(selection, row_ids=set(selection["row_ids"]))
+    for row_id, record in iter_roster(path):
+        if matches_selection(row_id, record, selection):
+            yield record
@@ -0,0 +1,90 @@
+import cProfile
+import functools
+import io
+import logging
+import pstats
+import time
+import tracemalloc
+from datetime import datetime
+
+
+class RunProfiler:
+    """
+    Coleta dados de desempenho de uma execução de envio:
+    cProfile, tempo de relógio por etapa instrumentada e snapshots do tracemalloc
+    """
+
+    def __init__(self, report_path: str):
+        """
+        Args:
+            report_path: Caminho do relatório (.txt); os dados brutos do cProfile
+                         são gravados ao lado com extensão .prof
+        """
+        self.report_path = report_path
+        self.profile = cProfile.Profile()
+        # label -> [chamadas, tempo total, maior tempo]
+        self.sections = {}
+        self._start_time = None
+        self._start_snapshot = None
+
+    def instrument(self, obj, method_names, prefix: str = ""):
+        """Substitui os métodos do objeto por versões que medem o tempo de relógio"""
+        for name in method_names:
+            method = getattr(obj, name)
+            setattr(obj, name, self._timed(f"{prefix}{name}", method))
+
+    def _timed(self, label, method):
+        stats = self.sections.setdefault(label, [0, 0.0, 0.0])
+
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                stats[0] += 1
+                stats[1] += elapsed
+                stats[2] = max(stats[2], elapsed)
+
+        return wrapper
+
+    def start(self):
+        """Inicia a coleta"""
+        tracemalloc.start(25)
+        self._start_snapshot = tracemalloc.take_snapshot()
+        self._start_time = time.perf_counter()
+        self.profile.enable()
+
+    def stop(self):
+        """Encerra a coleta e grava o relatório"""
+        self.profile.disable()
+        wall_time = time.perf_counter() - self._start_time
+        end_snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        prof_path = self.report_path.rsplit(".", 1)[0] + ".prof"
+        self.profile.dump_stats(prof_path)
+
+        with open(self.report_path, "w", encoding="utf-8") as f:
+            f.write(f"=== PROFILING DA EXECUÇÃO ({datetime.now().isoformat()}) ===\n")
+            f.write(f"Tempo total (relógio): {wall_time:.2f} s\n")
+            f.write(f"Memória rastreada: atual {current / 1024:.1f} KiB, pico {peak / 1024:.1f} KiB\n\n")
+
+            f.write("--- Tempo de relógio por etapa ---\n")
+            f.write(f"{'Etapa':<45} {'Chamadas':>9} {'Total (s)':>11} {'Média (s)':>11} {'Máx (s)':>10}\n")
+            for label, (calls, total, longest) in sorted(self.sections.items(), key=lambda item: -item[1][1]):
+                average = total / calls if calls else 0.0
+                f.write(f"{label:<45} {calls:>9} {total:>11.3f} {average:>11.3f} {longest:>10.3f}\n")
+
+            f.write("\n--- cProfile (top 40 por tempo cumulativo) ---\n")
+            stream = io.StringIO()
+            pstats.Stats(self.profile, stream=stream).sort_stats("cumulative").print_stats(40)
+            f.write(stream.getvalue())
+
+            f.write("\n--- tracemalloc (top 20 alocações desde o início) ---\n")
+            for stat in end_snapshot.compare_to(self._start_snapshot, "lineno")[:20]:
+                f.write(f"{stat}\n")
+
+        logging.info(f"Relatório de profiling gravado em {self.report_path} (dados do cProfile em {prof_path})")
@@ -9,25 +9,41 @@ from datetime import datetime
 import mimetypes
 from dotenv import load_dotenv
 from status_manager import StatusManager
+from retry_queue import RetryQueue, load_retry_policies_from_env
+from instance_health import INSTANCE_ERROR_CLASSES, CircuitBreaker, InstanceHealthMonitor
+from roster_store import ROSTER_PATH, RosterIndex, clean_cell, iter_selection
+from run_profiler import RunProfiler
+from idempotency_index import IdempotencyIndex
+from whatsapp_groups import GROUP_FIELDS, load_group_map
+from personalization import PersonalizationPipeline, TEMPLATE_EXTENSIONS
+from send_report import SendResults
 import sys
 import shutil
 import json
+import argparse
 
 # Carrega as variáveis do arquivo .env
 load_dotenv()
 
-# Configuração de logging
-logging.basicConfig(
-    level=logging.INFO, 
-    format="%(asctime)s - %(levelname)s - %(message)s",
-    handlers=[
-        logging.FileHandler(f'envio_comunicados_evolution_{datetime.now().strftime("%Y%m%d_%H%M%S")}.log', encoding='utf-8'),
-        logging.StreamHandler(sys.stdout)
-    ]
-)
+def setup_logging():
+    """
+    Configura o log da execução (arquivo + console) e retorna o caminho do arquivo
+    Chamada apenas em main(): os processos do pool de personalização reimportam este
+    módulo (start method 'spawn' no Windows/macOS) e não devem criar arquivos de log
+    """
+    log_file = f'envio_comunicados_evolution_{datetime.now().strftime("%Y%m%d_%H%M%S")}.log'
+    logging.basicConfig(
+        level=logging.INFO, 
+        format="%(asctime)s - %(levelname)s - %(message)s",
+        handlers=[
+            logging.FileHandler(log_file, encoding='utf-8'),
+            logging.StreamHandler(sys.stdout)
+        ]
+    )
+    return log_file
 
 class ComunicadosSenderEvolution:
-    def __init__(self, server_url, api_key, instance_name):
+    def __init__(self, server_url, api_key, instance_name, retry_policies=None, force_resend=False):
         """
         Inicializa o cliente Evolution API para envio de comunicados
         
@@ -35,6 +51,8 @@ class ComunicadosSenderEvolution:
             server_url: URL do servidor Evolution API (ex: https://api.evolution.com)
             api_key: Chave de API para autenticação
             instance_name: Nome da instância do WhatsApp
+            retry_policies: Políticas de reenvio por classe de erro ('timeout', '5xx', '429', 'network')
+            force_resend: Envia mesmo para quem já recebeu o mesmo comunicado dentro da janela
         """
         self.server_url = server_url.rstrip('/')
         self.api_key = api_key
@@ -43,15 +61,54 @@ class ComunicadosSenderEvolution:
             "Content-Type": "application/json",
             "apikey": api_key
         }
-        self.success_count = 0
-        self.failed_employees = []
-        self.sent_employees = []
+        # Resultado final por colaborador, exportado ao fim da execução
+        self.results = SendResults()
         self.status_manager = StatusManager("comunicados_status.json")
         self.sent_files_dir = "enviados_comunicados"
+        self.retry_queue = RetryQueue(retry_policies)
+        self.idempotency_index = IdempotencyIndex(window_hours=float(os.getenv("IDEMPOTENCY_WINDOW_HOURS", 72)))
+        self.force_resend = force_resend
+        self.content_hash = None
+        self.comunicado_filename = None
+        self.circuit_breaker = CircuitBreaker(int(os.getenv("CIRCUIT_BREAKER_FAILURES", 5)))
+        self.health_check_interval = float(os.getenv("HEALTH_CHECK_INTERVAL", 30))
+        self.max_pause_seconds = float(os.getenv("CIRCUIT_BREAKER_MAX_PAUSE", 3600))
+        # Rate limit (429) vale para a instância inteira: nenhum envio antes deste instante (time.monotonic)
+        self.rate_limited_until = 0.0
         
         # Criar diretório de arquivos enviados se não existir
         os.makedirs(self.sent_files_dir, exist_ok=True)
         
+    def wait_for_instance(self):
+        """
+        Aguarda enquanto o disjuntor estiver aberto (instância desconectada)
+        Interrompe a execução se a pausa exceder CIRCUIT_BREAKER_MAX_PAUSE
+        """
+        if not self.circuit_breaker.is_open:
+            return
+        
+        reason = self.circuit_breaker.reason
+        logging.warning(f"Envio pausado: {reason}. Aguardando reconexão da instância...")
+        self.status_manager.update_current_step(f"⏸️ Envio pausado: {reason}")
+        if not self.circuit_breaker.wait_until_closed(self.max_pause_seconds):
+            raise RuntimeError(f"Instância não reconectou em {self.max_pause_seconds:.0f} segundos")
+        logging.info("Instância reconectada. Retomando envios.")
+    
+    def start_rate_limit_cooldown(self, seconds):
+        """Pausa todos os envios por 'seconds' segundos após um rate limit (429)"""
+        self.rate_limited_until = max(self.rate_limited_until, time.monotonic() + seconds)
+        logging.warning(f"Rate limit da instância: envios pausados por {seconds:.0f} segundos")
+    
+    def wait_for_rate_limit(self):
+        """Aguarda o fim da pausa por rate limit, se houver"""
+        wait_time = self.rate_limited_until - time.monotonic()
+        if wait_time <= 0:
+            return
+        
+        self.status_manager.update_current_step(f"⏸️ Rate limit atingido: envios pausados por {wait_time:.0f} segundos")
+        logging.info(f"Aguardando {wait_time:.1f} segundos pelo fim do rate limit...")
+        time.sleep(wait_time)
+    
     def add_random_delay(self, base_delay=15, variation=5):
         """Adiciona delay aleatório para parecer mais humano"""
         delay = base_delay + random.uniform(-variation, variation)
@@ -76,8 +133,61 @@ class ComunicadosSenderEvolution:
         
         return clean_number
     
-    def send_text_message(self, number, text, delay=0, retry_count=3):
-        """Envia mensagem de texto usando Evolution API"""
+    def _post_message(self, url, payload, timeout, number, description):
+        """
+        Faz uma única tentativa de envio para a Evolution API
+        Retorna dict com 'ok', 'error_class' e 'message_id'.
+        error_class: None (sucesso), 'timeout', '5xx', '429', 'network' ou 'fatal' (sem reenvio)
+        """
+        try:
+            response = requests.post(url, headers=self.headers, json=payload, timeout=timeout)
+            response.raise_for_status()
+            
+            result = response.json()
+            message_id = result.get('key', {}).get('id')
+            logging.info(f"{description} enviada com sucesso para {number}. ID: {message_id or 'N/A'}")
+            return {"ok": True, "error_class": None, "message_id": message_id}
+            
+        except requests.exceptions.HTTPError as e:
+            status_code = e.response.status_code
+            if status_code == 401:
+                logging.error(f"Erro 401 Unauthorized - Verifique a API key")
+                error_class = "fatal"
+            elif status_code == 404:
+                logging.error(f"Erro 404 - Instância {self.instance_name} não encontrada")
+                error_class = "fatal"
+            elif status_code == 413:
+                logging.error(f"Arquivo muito grande para {number}. Pulando...")
+                error_class = "fatal"
+            elif status_code == 429:
+                logging.warning(f"Rate limit atingido ao enviar {description.lower()} para {number}")
+                error_class = "429"
+            elif status_code >= 500:
+                logging.error(f"Erro HTTP {status_code} ao enviar {description.lower()} para {number}: {e}")
+                error_class = "5xx"
+            else:
+                logging.error(f"Erro HTTP {status_code} ao enviar {description.lower()} para {number}: {e}")
+                error_class = "fatal"
+                
+        except requests.exceptions.Timeout:
+            logging.warning(f"Timeout ao enviar {description.lower()} para {number}")
+            error_class = "timeout"
+            
+        except requests.exceptions.RequestException as e:
+            logging.error(f"Erro de requisição ao enviar {description.lower()} para {number}: {e}")
+            error_class = "network"
+            
+        except Exception as e:
+            logging.error(f"Erro inesperado ao enviar {description.lower()} para {number}: {e}")
+            error_class = "fatal"
+        
+        return {"ok": False, "error_class": error_class, "message_id": None}
+    
+    def send_text_message(self, number, text, delay=0):
+        """
+        Envia mensagem de texto usando Evolution API (uma tentativa)
+        Reenvios são agendados na fila de reenvios pelo chamador
+        """
         url = f"{self.server_url}/message/sendText/{self.instance_name}"
         
         payload = {
@@ -86,46 +196,7 @@ class ComunicadosSenderEvolution:
             "delay": delay
         }
         
-        for attempt in range(retry_count):
-            try:
-                response = requests.post(url, headers=self.headers, json=payload, timeout=30)
-                response.raise_for_status()
-                
-                result = response.json()
-                logging.info(f"Mensagem enviada com sucesso para {number}. ID: {result.get('key', {}).get('id', 'N/A')}")
-                return True
-                
-            except requests.exceptions.HTTPError as e:
-                if e.response.status_code == 401:
-                    logging.error(f"Erro 401 Unauthorized - Verifique a API key")
-                    return False
-                elif e.response.status_code == 404:
-                    logging.error(f"Erro 404 - Instância {self.instance_name} não encontrada")
-                    return False
-                elif e.response.status_code == 429:
-                    logging.warning(f"Rate limit atingido. Aguardando 60 segundos...")
-                    time.sleep(60)
-                    continue
-                else:
-                    logging.error(f"Erro HTTP {e.response.status_code} ao enviar mensagem para {number}: {e}")
-                    
-            except requests.exceptions.Timeout:
-                logging.warning(f"Timeout na tentativa {attempt + 1} para {number}")
-                if attempt < retry_count - 1:
-                    time.sleep(10)
-                    continue
-                    
-            except requests.exceptions.RequestException as e:
-                logging.error(f"Erro de requisição ao enviar mensagem para {number}: {e}")
-                
-            except Exception as e:
-                logging.error(f"Erro inesperado ao enviar mensagem para {number}: {e}")
-            
-            if attempt < retry_count - 1:
-                logging.info(f"Tentativa {attempt + 1} falhou. Tentando novamente em 30 segundos...")
-                time.sleep(30)
-        
-        return False
+        return self._post_message(url, payload, 30, number, "Mensagem")
     
     def file_to_base64(self, file_path):
         """Converte arquivo para base64"""
@@ -137,14 +208,17 @@ class ComunicadosSenderEvolution:
             logging.error(f"Erro ao converter arquivo para base64: {e}")
             return None
     
-    def send_media_message(self, number, file_path, filename=None, caption=None, delay=0, retry_count=3):
-        """Envia arquivo de mídia usando Evolution API"""
+    def send_media_message(self, number, file_path, filename=None, caption=None, delay=0):
+        """
+        Envia arquivo de mídia usando Evolution API (uma tentativa)
+        Reenvios são agendados na fila de reenvios pelo chamador
+        """
         url = f"{self.server_url}/message/sendMedia/{self.instance_name}"
         
         # Converte arquivo para base64
         base64_content = self.file_to_base64(file_path)
         if not base64_content:
-            return False
+            return {"ok": False, "error_class": "fatal", "message_id": None}
         
         # Determina o tipo de mídia baseado na extensão
         file_extension = os.path.splitext(file_path)[1].lower()
@@ -179,52 +253,13 @@ class ComunicadosSenderEvolution:
             "delay": delay
         }
         
-        for attempt in range(retry_count):
-            try:
-                response = requests.post(url, headers=self.headers, json=payload, timeout=60)
-                response.raise_for_status()
-                
-                result = response.json()
-                logging.info(f"Mídia enviada com sucesso para {number}. ID: {result.get('key', {}).get('id', 'N/A')}")
-                return True
-                
-            except requests.exceptions.HTTPError as e:
-                if e.response.status_code == 401:
-                    logging.error(f"Erro 401 Unauthorized - Verifique a API key")
-                    return False
-                elif e.response.status_code == 404:
-                    logging.error(f"Erro 404 - Instância {self.instance_name} não encontrada")
-                    return False
-                elif e.response.status_code == 413:
-                    logging.error(f"Arquivo muito grande para {number}. Pulando...")
-                    return False
-                elif e.response.status_code == 429:
-                    logging.warning(f"Rate limit atingido. Aguardando 120 segundos...")
-                    time.sleep(120)
-                    continue
-                else:
-                    logging.error(f"Erro HTTP {e.response.status_code} ao enviar mídia para {number}: {e}")
-                    
-            except requests.exceptions.Timeout:
-                logging.warning(f"Timeout na tentativa {attempt + 1} para envio de mídia para {number}")
-                if attempt < retry_count - 1:
-                    time.sleep(20)
-                    continue
-                    
-            except requests.exceptions.RequestException as e:
-                logging.error(f"Erro de requisição ao enviar mídia para {number}: {e}")
-                
-            except Exception as e:
-                logging.error(f"Erro inesperado ao enviar mídia para {number}: {e}")
-            
-            if attempt < retry_count - 1:
-                logging.info(f"Tentativa {attempt + 1} falhou. Tentando novamente em 60 segundos...")
-                time.sleep(60)
-        
-        return False
+        return self._post_message(url, payload, 60, number, "Mídia")
     
-    def check_instance_status(self):
-        """Verifica o status da instância"""
+    def check_instance_status(self, verbose=True):
+        """
+        Verifica o status da instância
+        verbose=False omite o log de status quando conectada (usado pelo monitor de saúde)
+        """
         url = f"{self.server_url}/instance/connectionState/{self.instance_name}"
         
         try:
@@ -234,7 +269,8 @@ class ComunicadosSenderEvolution:
             result = response.json()
             # A partir da v2.2.2, o status pode vir em 'state' ou 'status'
             status = result.get('instance', {}).get('state', result.get('instance', {}).get('status', 'unknown'))
-            logging.info(f"Status da instância {self.instance_name}: {status}")
+            if verbose:
+                logging.info(f"Status da instância {self.instance_name}: {status}")
             
             if status != 'open' and status != 'connected': # Adicionado 'connected' para v2.2.2+
                 logging.warning(f"Instância não está conectada. Status: {status}")
@@ -262,7 +298,7 @@ class ComunicadosSenderEvolution:
 
         if phone_number == "nan" or not phone_number.strip():
             logging.warning(f"Número de telefone inválido para {employee_name}. Pulando...")
-            self.failed_employees.append({"nome": employee_name, "motivo": "Telefone inválido"})
+            self._add_result(colaborador, phone_number, "failed", "Telefone inválido")
             self.status_manager.update_employee_status(unique_id, employee_name, phone_number, "failed", "Telefone inválido")
             return False
 
@@ -271,48 +307,313 @@ class ComunicadosSenderEvolution:
         
         logging.info(f"Iniciando envio para {employee_name} (Setor: {setor}, Obra: {obra}) no número {formatted_phone}...")
 
-        # Mensagem personalizada com informações do colaborador
-        personalized_message = f"{mensagem}"
-        
-        # Enviar mensagem de texto se houver
-        if mensagem.strip():
-            self.status_manager.update_employee_status(unique_id, employee_name, formatted_phone, "processing", "Enviando mensagem")
-            if not self.send_text_message(formatted_phone, personalized_message):
-                logging.error(f"Falha ao enviar mensagem para {employee_name}")
-                self.failed_employees.append({"nome": employee_name, "motivo": "Falha na mensagem"})
-                self.status_manager.update_employee_status(unique_id, employee_name, formatted_phone, "failed", "Falha na mensagem")
-                return False
-            # Delay entre mensagem e arquivo, se ambos existirem
-            if comunicado_path and os.path.exists(comunicado_path):
-                self.add_random_delay(20, 8)
-
-        # Envio do comunicado (arquivo) se houver
+        # Etapas de envio: mensagem de texto e/ou comunicado (arquivo)
+        pending_steps = []
+        if mensagem and mensagem.strip():
+            pending_steps.append("text")
         if comunicado_path and os.path.exists(comunicado_path):
-            self.status_manager.update_employee_status(unique_id, employee_name, formatted_phone, "processing", "Enviando comunicado")
-            filename = os.path.basename(comunicado_path)
-            if not self.send_media_message(formatted_phone, comunicado_path, filename, caption=personalized_message if not (mensagem and mensagem.strip()) else None):
-                logging.error(f"Falha ao enviar comunicado para {employee_name}")
-                self.failed_employees.append({"nome": employee_name, "motivo": "Falha no envio do comunicado"})
-                self.status_manager.update_employee_status(unique_id, employee_name, formatted_phone, "failed", "Falha no envio do comunicado")
-                return False
+            pending_steps.append("media")
         
         # Se nem mensagem nem comunicado foram enviados, é um erro
-        if not mensagem.strip() and (not comunicado_path or not os.path.exists(comunicado_path)):
+        if not pending_steps:
             logging.error(f"Nenhuma mensagem ou comunicado para enviar para {employee_name}")
-            self.failed_employees.append({"nome": employee_name, "motivo": "Nenhum conteúdo para enviar"})
+            self._add_result(colaborador, formatted_phone, "failed", "Nenhum conteúdo para enviar")
             self.status_manager.update_employee_status(unique_id, employee_name, formatted_phone, "failed", "Nenhum conteúdo para enviar")
             return False
 
-        self.success_count += 1
-        self.sent_employees.append({"nome": employee_name, "telefone": formatted_phone, "setor": setor, "obra": obra})
-        self.status_manager.update_employee_status(unique_id, employee_name, formatted_phone, "success", "Comunicado enviado com sucesso")
+        # Não reenvia o mesmo comunicado a quem já o recebeu dentro da janela
+        delivered_at = None if self.force_resend else self.idempotency_index.delivered_at(formatted_phone, self.content_hash)
+        if delivered_at:
+            sent_at = datetime.fromisoformat(delivered_at).strftime('%d/%m/%Y %H:%M')
+            logging.info(f"{employee_name} já recebeu este comunicado em {sent_at}. Pulando...")
+            self._add_result(colaborador, formatted_phone, "skipped", f"Comunicado já enviado em {sent_at}")
+            self.status_manager.update_employee_status(unique_id, employee_name, formatted_phone, "skipped", f"Comunicado já enviado em {sent_at}")
+            return True
+
+        return self._send_steps(colaborador, pending_steps, comunicado_path, mensagem, attempt=0)
+
+    def _send_steps(self, colaborador, pending_steps, comunicado_path, mensagem, attempt):
+        """
+        Executa as etapas pendentes de envio para um colaborador
+        Em caso de falha recuperável, agenda as etapas restantes na fila de reenvios
+        Retorna True (sucesso), False (falha definitiva) ou None (reenvio agendado)
+        """
+        employee_name = colaborador["Nome"]
+        phone_number = str(colaborador["Telefone"])
+        unique_id = f"{employee_name}_{phone_number}"
+        formatted_phone = self.format_phone_number(phone_number)
+        
+        # Mensagem personalizada com informações do colaborador (mensagem vazia vira None)
+        personalized_message = (mensagem or "").strip() or None
+        
+        # IDs das mensagens aceitas pela API, para associar os recibos do webhook
+        sent_message_ids = []
+        
+        for step_index, step in enumerate(pending_steps):
+            # Pausa sem consumir tentativas enquanto a instância estiver indisponível ou em rate limit
+            self.wait_for_instance()
+            self.wait_for_rate_limit()
+            
+            if step == "text":
+                self.status_manager.update_employee_status(unique_id, employee_name, formatted_phone, "processing", "Enviando mensagem", message_ids=sent_message_ids)
+                result = self.send_text_message(formatted_phone, personalized_message)
+                failure_reason = "Falha na mensagem"
+            else:
+                self.status_manager.update_employee_status(unique_id, employee_name, formatted_phone, "processing", "Enviando comunicado", message_ids=sent_message_ids)
+                # Comunicados personalizados são enviados com o nome do arquivo original
+                filename = self.comunicado_filename or os.path.basename(comunicado_path)
+                # A mensagem vai como texto separado (também num reenvio só do arquivo), então o comunicado segue sem legenda
+                result = self.send_media_message(formatted_phone, comunicado_path, filename, caption=None)
+                failure_reason = "Falha no envio do comunicado"
+            
+            if result["ok"]:
+                self.circuit_breaker.record_success()
+                if result["message_id"]:
+                    sent_message_ids.append(result["message_id"])
+                    # Grava o ID já, antes do delay até a próxima etapa: o recibo de entrega chega em segundos
+                    if step_index < len(pending_steps) - 1:
+                        self.status_manager.update_employee_status(unique_id, employee_name, formatted_phone, "processing", "Mensagem enviada", message_ids=sent_message_ids)
+            else:
+                remaining_steps = pending_steps[step_index:]
+                self.circuit_breaker.record_failure(result["error_class"])
+                if self.circuit_breaker.is_open and result["error_class"] in INSTANCE_ERROR_CLASSES:
+                    # Falha causada pela indisponibilidade da instância: reagenda sem consumir tentativa
+                    self.retry_queue.requeue(colaborador, remaining_steps, attempt, result["error_class"], comunicado_path)
+                    logging.warning(f"Instância indisponível durante envio para {employee_name}. Reagendado sem consumir tentativa")
+                    self.status_manager.update_employee_status(unique_id, employee_name, formatted_phone, "retrying", f"{failure_reason} - aguardando reconexão da instância", message_ids=sent_message_ids)
+                    return None
+                
+                entry = self.retry_queue.schedule(colaborador, remaining_steps, attempt + 1, result["error_class"], comunicado_path)
+                if result["error_class"] == "429":
+                    # Os próximos colaboradores também receberiam 429: pausa a passagem inteira pelo backoff
+                    cooldown = entry.due_time - time.monotonic() if entry else self.retry_queue.policies["429"].backoff(attempt + 1)
+                    self.start_rate_limit_cooldown(cooldown)
+                if entry is not None:
+                    wait_time = entry.due_time - time.monotonic()
+                    logging.warning(f"Falha ({result['error_class']}) para {employee_name}. Reenvio agendado em {wait_time:.0f} segundos ({self._attempt_label(entry)})")
+                    self.status_manager.update_employee_status(unique_id, employee_name, formatted_phone, "retrying", f"{failure_reason} - reenvio agendado ({self._attempt_label(entry)})", message_ids=sent_message_ids)
+                    return None
+                
+                logging.error(f"{failure_reason} para {employee_name}")
+                self._add_result(colaborador, formatted_phone, "failed", failure_reason)
+                self.status_manager.update_employee_status(unique_id, employee_name, formatted_phone, "failed", failure_reason, message_ids=sent_message_ids)
+                return False
+            
+            # Delay entre mensagem e arquivo, se ambos existirem
+            if step_index < len(pending_steps) - 1:
+                self.add_random_delay(20, 8)
+
+        self.idempotency_index.record(formatted_phone, self.content_hash)
+        self._add_result(colaborador, formatted_phone, "success")
+        self.status_manager.update_employee_status(unique_id, employee_name, formatted_phone, "success", "Comunicado enviado com sucesso", message_ids=sent_message_ids)
         
         logging.info(f"✅ Processo completo para {employee_name}!")
         
         return True
 
-    def send_comunicados_to_api(self, colaboradores_data, comunicado_path, mensagem):
-        """Função principal para envio dos comunicados"""
+    def _attempt_label(self, entry):
+        """
+        Número da tentativa que o reenvio vai executar, usado em todos os logs e status do reenvio
+        entry.attempt conta as tentativas já feitas, então o reenvio é a tentativa entry.attempt + 1
+        """
+        policy = self.retry_queue.policies.get(entry.error_class)
+        total = f"/{policy.max_attempts}" if policy else ""
+        return f"tentativa {entry.attempt + 1}{total}"
+
+    def process_due_retries(self, comunicado_path, mensagem, wait=False):
+        """
+        Processa os reenvios da fila cujo backoff já venceu
+        Com wait=True, aguarda até que a fila esteja vazia (passagem final de reenvios)
+        """
+        while True:
+            entry = self.retry_queue.pop_due()
+            if entry is None:
+                if not wait or not len(self.retry_queue):
+                    return
+                wait_time = self.retry_queue.seconds_until_next()
+                self.status_manager.update_current_step(f"Aguardando reenvios ({len(self.retry_queue)} pendente(s))")
+                logging.info(f"Aguardando {wait_time:.1f} segundos para o próximo reenvio...")
+                time.sleep(wait_time)
+                continue
+            
+            employee_name = entry.colaborador["Nome"]
+            logging.info(f"\n--- Reenvio para {employee_name} ({self._attempt_label(entry)}, {entry.error_class}) ---")
+            self.status_manager.update_current_step(f"Reenviando para {employee_name}", employee_name)
+            self._send_steps(entry.colaborador, entry.pending_steps, entry.comunicado_path or comunicado_path, mensagem, entry.attempt)
+            
+            # Delay entre colaboradores também nos reenvios
+            if len(self.retry_queue) or not wait:
+                self.add_random_delay(30, 10)
+
+    def _fail_pending_retries(self):
+        """Marca como falha os reenvios que não chegaram a ser executados"""
+        for entry in self.retry_queue.drain():
+            employee_name = entry.colaborador["Nome"]
+            phone_number = str(entry.colaborador["Telefone"])
+            unique_id = f"{employee_name}_{phone_number}"
+            formatted_phone = self.format_phone_number(phone_number)
+            self._add_result(entry.colaborador, formatted_phone, "failed", "Reenvio não realizado")
+            self.status_manager.update_employee_status(unique_id, employee_name, formatted_phone, "failed", "Reenvio não realizado")
+
+    def _add_result(self, colaborador, phone, status_type, reason=""):
+        """Registra o resultado final do colaborador ('success', 'failed' ou 'skipped') para o relatório"""
+        self.results.add(colaborador["Nome"], phone, colaborador.get("Setor", "N/A"), colaborador.get("Obra", "N/A"), status_type, reason)
+
+    def get_group_participants(self, group_jid):
+        """
+        Retorna os telefones dos participantes de um grupo
+        Retorna None se não for possível consultar o grupo
+        """
+        url = f"{self.server_url}/group/participants/{self.instance_name}"
+        
+        try:
+            response = requests.get(url, headers=self.headers, params={"groupJid": group_jid}, timeout=30)
+            response.raise_for_status()
+            
+            participants = set()
+            for participant in response.json().get('participants', []):
+                # Versões recentes trazem o número em 'phoneNumber' quando 'id' é um LID
+                participant_id = participant.get('phoneNumber') or participant.get('id', '')
+                participants.add(participant_id.split('@')[0])
+            return participants
+            
+        except Exception as e:
+            logging.error(f"Erro ao consultar participantes do grupo {group_jid}: {e}")
+            return None
+    
+    def _send_to_group(self, group_jid, group_name, comunicado_path, mensagem):
+        """
+        Envia a mensagem e/ou o comunicado uma única vez para o grupo
+        Como são poucos envios (um por grupo), os reenvios seguem as políticas
+        de backoff de forma síncrona, sem passar pela fila de reenvios
+        """
+        steps = []
+        if mensagem and mensagem.strip():
+            steps.append("text")
+        if comunicado_path and os.path.exists(comunicado_path):
+            steps.append("media")
+        if not steps:
+            logging.error(f"Nenhuma mensagem ou comunicado para enviar para o grupo {group_name}")
+            return False
+        
+        for step_index, step in enumerate(steps):
+            attempt = 0
+            while True:
+                self.wait_for_instance()
+                self.wait_for_rate_limit()
+                if step == "text":
+                    result = self.send_text_message(group_jid, mensagem)
+                else:
+                    filename = os.path.basename(comunicado_path)
+                    result = self.send_media_message(group_jid, comunicado_path, filename, caption=None)
+                
+                if result["ok"]:
+                    self.circuit_breaker.record_success()
+                    break
+                
+                self.circuit_breaker.record_failure(result["error_class"])
+                if self.circuit_breaker.is_open and result["error_class"] in INSTANCE_ERROR_CLASSES:
+                    # Aguarda a reconexão sem consumir tentativa
+                    continue
+                attempt += 1
+                policy = self.retry_queue.policies.get(result["error_class"])
+                if policy is None or attempt >= policy.max_attempts:
+                    return False
+                wait_time = policy.backoff(attempt)
+                logging.warning(f"Falha ({result['error_class']}) no envio para o grupo {group_name}. Tentativa {attempt + 1}/{policy.max_attempts} em {wait_time:.0f} segundos")
+                if result["error_class"] == "429":
+                    # A pausa vale também para os grupos seguintes
+                    self.start_rate_limit_cooldown(wait_time)
+                    continue
+                time.sleep(wait_time)
+            
+            # Delay entre mensagem e arquivo, se ambos existirem
+            if step_index < len(steps) - 1:
+                self.add_random_delay(20, 8)
+        
+        return True
+    
+    def _phone_in_group(self, formatted_phone, participants):
+        """Verifica se o telefone está no grupo, considerando números antigos sem o nono dígito"""
+        if formatted_phone in participants:
+            return True
+        return len(formatted_phone) == 13 and formatted_phone[:4] + formatted_phone[5:] in participants
+    
+    def broadcast_to_groups(self, colaboradores_data, comunicado_path, mensagem, group_kind, group_map):
+        """
+        Envia o comunicado uma vez por grupo do WhatsApp (por obra ou setor)
+        O status de cada colaborador é definido pela participação no grupo
+        group_kind: 'obra' ou 'setor'
+        group_map: {nome da obra/setor: JID do grupo}
+        """
+        group_field = GROUP_FIELDS[group_kind]
+        groups = {}
+        for colaborador in colaboradores_data:
+            groups.setdefault(clean_cell(colaborador.get(group_field)), []).append(colaborador)
+        
+        for index, (group_name, members) in enumerate(groups.items()):
+            logging.info(f"\n--- Grupo {index + 1}/{len(groups)}: {group_field} {group_name} ({len(members)} colaboradores) ---")
+            self.status_manager.update_current_step(f"Enviando para o grupo {group_name}")
+            
+            group_jid = group_map.get(group_name)
+            if not group_jid:
+                reason = f"{group_field} sem grupo do WhatsApp mapeado"
+                logging.error(f"{reason}: {group_name}")
+                for colaborador in members:
+                    self._record_group_member(colaborador, group_name, "failed", reason)
+                continue
+            
+            # Não reenvia ao grupo o mesmo comunicado dentro da janela (mesma regra do envio individual)
+            delivered_at = None if self.force_resend else self.idempotency_index.delivered_at(group_jid, self.content_hash)
+            if delivered_at:
+                sent_at = datetime.fromisoformat(delivered_at).strftime('%d/%m/%Y %H:%M')
+                logging.info(f"O grupo {group_name} já recebeu este comunicado em {sent_at}. Pulando...")
+                for colaborador in members:
+                    self._record_group_member(colaborador, group_name, "skipped", f"Comunicado já enviado no grupo {group_name} em {sent_at}")
+                continue
+            
+            if not self._send_to_group(group_jid, group_name, comunicado_path, mensagem):
+                logging.error(f"Falha no envio para o grupo {group_name}")
+                for colaborador in members:
+                    self._record_group_member(colaborador, group_name, "failed", "Falha no envio para o grupo")
+                continue
+            self.idempotency_index.record(group_jid, self.content_hash)
+            
+            participants = self.get_group_participants(group_jid)
+            for colaborador in members:
+                formatted_phone = self.format_phone_number(str(colaborador["Telefone"]))
+                if participants is None:
+                    self._record_group_member(colaborador, group_name, "success", f"Enviado no grupo {group_name} (participação não verificada)")
+                elif self._phone_in_group(formatted_phone, participants):
+                    self._record_group_member(colaborador, group_name, "success", f"Enviado no grupo {group_name}")
+                else:
+                    self._record_group_member(colaborador, group_name, "failed", f"Não participa do grupo {group_name}")
+            
+            # Delay entre grupos
+            if index < len(groups) - 1:
+                self.add_random_delay(30, 10)
+    
+    def _record_group_member(self, colaborador, group_name, status_type, message):
+        """Registra o resultado do envio por grupo para um colaborador"""
+        employee_name = colaborador["Nome"]
+        phone_number = str(colaborador["Telefone"])
+        unique_id = f"{employee_name}_{phone_number}"
+        formatted_phone = self.format_phone_number(phone_number)
+        
+        if status_type == "success":
+            self.idempotency_index.record(formatted_phone, self.content_hash)
+        self._add_result(colaborador, formatted_phone, status_type, message)
+        self.status_manager.update_employee_status(unique_id, employee_name, formatted_phone, status_type, message)
+
+    def send_comunicados_to_api(self, colaboradores_data, comunicado_path, mensagem, total_employees=None,
+                                group_kind=None, group_map=None, personalize=False):
+        """
+        Função principal para envio dos comunicados
+        colaboradores_data pode ser uma lista ou um iterador (lido sob demanda);
+        para iteradores, informe total_employees
+        Com group_kind ('obra' ou 'setor'), envia uma vez por grupo do WhatsApp (ver broadcast_to_groups)
+        Com personalize=True, cada colaborador recebe a imagem com seu nome, setor e obra
+        """
         
         # Verificar se já há uma execução em andamento
         if self.status_manager.is_running():
@@ -328,8 +629,20 @@ class ComunicadosSenderEvolution:
         if comunicado_path and not os.path.exists(comunicado_path):
             logging.error(f"Arquivo de comunicado não encontrado: {comunicado_path}")
             return
+        
+        # Verificar se o comunicado pode ser personalizado
+        if personalize:
+            if group_kind:
+                logging.warning("Personalização não se aplica ao envio por grupo. Enviando o comunicado original.")
+                personalize = False
+            elif not comunicado_path or not comunicado_path.lower().endswith(TEMPLATE_EXTENSIONS):
+                logging.error(f"Personalização disponível apenas para imagens ({', '.join(TEMPLATE_EXTENSIONS)}). Abortando envio.")
+                return
 
-        total_employees = len(colaboradores_data)
+        if total_employees is None:
+            total_employees = len(colaboradores_data)
+        self.content_hash = IdempotencyIndex.content_hash(mensagem, comunicado_path)
+        self.comunicado_filename = os.path.basename(comunicado_path) if comunicado_path else None
         execution_id = datetime.now().strftime("%Y%m%d_%H%M%S")
         
         # Iniciar execução
@@ -342,26 +655,64 @@ class ComunicadosSenderEvolution:
         logging.info(f"Arquivo: {comunicado_path}")
         logging.info(f"ID da execução: {execution_id}")
 
+        # Monitor de saúde da instância durante a execução
+        health_monitor = InstanceHealthMonitor(
+            lambda: self.check_instance_status(verbose=False),
+            self.circuit_breaker,
+            self.health_check_interval
+        )
+        health_monitor.start()
+
         try:
-            for index, colaborador in enumerate(colaboradores_data):
-                logging.info(f"\n--- Processando colaborador {index + 1}/{total_employees} ---")
-                
-                success = self.process_employee(colaborador, comunicado_path, mensagem)
+            if group_kind:
+                self.broadcast_to_groups(colaboradores_data, comunicado_path, mensagem, group_kind, group_map or {})
+            else:
+                if personalize:
+                    # Comunicados personalizados gerados no pool, poucos colaboradores à frente do envio
+                    recipients = PersonalizationPipeline(
+                        comunicado_path, colaboradores_data,
+                        lookahead=int(os.getenv("PERSONALIZATION_LOOKAHEAD", 4))
+                    )
+                else:
+                    recipients = ((colaborador, comunicado_path) for colaborador in colaboradores_data)
                 
-                # Delay entre funcionários (mais longo para evitar spam)
-                if index < total_employees - 1:  # Não fazer delay no último
-                    self.add_random_delay(30, 10)  # Delay maior entre colaboradores
+                for index, (colaborador, employee_comunicado_path) in enumerate(recipients):
+                    logging.info(f"\n--- Processando colaborador {index + 1}/{total_employees} ---")
+                    
+                    skipped_before = self.results.counts["skipped"]
+                    if employee_comunicado_path is None and comunicado_path:
+                        employee_name = colaborador["Nome"]
+                        phone_number = str(colaborador["Telefone"])
+                        self._add_result(colaborador, phone_number, "failed", "Falha na personalização do comunicado")
+                        self.status_manager.update_employee_status(f"{employee_name}_{phone_number}", employee_name, phone_number, "failed", "Falha na personalização do comunicado")
+                    else:
+                        success = self.process_employee(colaborador, employee_comunicado_path, mensagem)
+                    
+                    # Delay entre funcionários (mais longo para evitar spam)
+                    # Sem delay quando o colaborador foi pulado por já ter recebido o comunicado
+                    if index < total_employees - 1 and self.results.counts["skipped"] == skipped_before:  # Não fazer delay no último
+                        self.add_random_delay(30, 10)  # Delay maior entre colaboradores
+                        # Intercala os reenvios que já venceram o backoff
+                        self.process_due_retries(comunicado_path, mensagem)
                 
+                # Passagem final: aguarda e executa os reenvios restantes
+                if len(self.retry_queue):
+                    logging.info(f"\n--- Passagem final de reenvios ({len(self.retry_queue)} pendente(s)) ---")
+                    self.process_due_retries(comunicado_path, mensagem, wait=True)
+                    
         except KeyboardInterrupt:
             logging.warning("Execução interrompida pelo usuário")
         except Exception as e:
             logging.error(f"Erro durante a execução: {e}")
         finally:
+            health_monitor.stop()
+            self._fail_pending_retries()
+            
             # Finalizar execução
             self.status_manager.end_execution()
             
             # Mover arquivo de comunicado para pasta 'enviados' se houve pelo menos um sucesso
-            if self.success_count > 0:
+            if self.results.counts["success"] > 0 and comunicado_path:
                 try:
                     filename = os.path.basename(comunicado_path)
                     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
@@ -375,31 +726,129 @@ class ComunicadosSenderEvolution:
         # Relatório final
         logging.info(f"\n=== RELATÓRIO FINAL ===")
         logging.info(f"Total de colaboradores processados: {total_employees}")
-        logging.info(f"Envios bem-sucedidos: {self.success_count}")
-        logging.info(f"Envios falharam: {len(self.failed_employees)}")
-        
-        if self.failed_employees:
-            logging.info("\nColaboradores que falharam:")
-            for emp in self.failed_employees:
-                logging.info(f"- {emp['nome']}: {emp['motivo']}")
-        
-        if self.sent_employees:
-            logging.info("\nColaboradores que receberam o comunicado:")
-            for emp in self.sent_employees:
-                logging.info(f"- {emp['nome']} ({emp['setor']}/{emp['obra']}): {emp['telefone']}")
+        logging.info(f"Envios bem-sucedidos: {self.results.counts['success']}")
+        logging.info(f"Já haviam recebido (pulados): {self.results.counts['skipped']}")
+        logging.info(f"Envios falharam: {self.results.counts['failed']}")
+        
+        # Detalhes por colaborador no relatório exportado, em vez de uma linha de log por colaborador
+        if len(self.results):
+            try:
+                report_paths = self.results.export(execution_id)
+                logging.info(f"Relatório por colaborador: {', '.join(report_paths)}")
+            except Exception as e:
+                logging.error(f"Erro ao exportar relatório: {e}")
+
+def parse_args(argv=None):
+    """Argumentos de linha de comando para o modo headless (cron/automação)"""
+    parser = argparse.ArgumentParser(
+        description="Envio de comunicados via Evolution API. Sem --roster, usa os dados gerados pelo app Streamlit."
+    )
+    parser.add_argument("--roster", help="Planilha de colaboradores (.xlsx ou .csv)")
+    parser.add_argument("--setor", action="append", default=[], help="Filtra por setor (pode repetir)")
+    parser.add_argument("--obra", action="append", default=[], help="Filtra por obra (pode repetir)")
+    parser.add_argument("--mensagem", default="", help="Mensagem de texto a enviar")
+    parser.add_argument("--mensagem-arquivo", help="Arquivo de texto com a mensagem a enviar")
+    parser.add_argument("--arquivo", help="Arquivo de comunicado (imagem ou PDF)")
+    parser.add_argument("--profile", action="store_true", help="Gera relatório de profiling ao lado do log")
+    parser.add_argument("--grupo", choices=sorted(GROUP_FIELDS), help="Envia uma vez por grupo do WhatsApp da obra ou setor (ver grupos_whatsapp.json)")
+    parser.add_argument("--grupo-parcial", action="store_true", help="Confirma o envio por grupo mesmo quando só parte da obra/setor foi selecionada (todo o grupo recebe)")
+    parser.add_argument("--personalizar", action="store_true", help="Adiciona nome, setor e obra de cada colaborador à imagem do comunicado")
+    parser.add_argument("--forcar-reenvio", action="store_true", help="Envia mesmo para quem já recebeu o mesmo comunicado")
+    return parser.parse_args(argv)
+
+def load_headless_data(args):
+    """
+    Prepara o envio a partir da planilha, sem passar pelo Streamlit nem pelo arquivo temporário
+    """
+    if not os.path.exists(args.roster):
+        logging.error(f"Planilha de colaboradores não encontrada: {args.roster}")
+        return None
+    
+    if not (args.mensagem.strip() or args.mensagem_arquivo or args.arquivo):
+        logging.error("Nada para enviar: informe --mensagem, --mensagem-arquivo e/ou --arquivo")
+        return None
+    
+    if args.arquivo and not os.path.exists(args.arquivo):
+        logging.error(f"Arquivo de comunicado não encontrado: {args.arquivo}")
+        return None
+    
+    mensagem = args.mensagem
+    if args.mensagem_arquivo:
+        try:
+            with open(args.mensagem_arquivo, 'r', encoding='utf-8') as f:
+                mensagem = f.read()
+        except (OSError, UnicodeDecodeError) as e:
+            logging.error(f"Erro ao ler o arquivo de mensagem {args.mensagem_arquivo}: {e}")
+            return None
+        if not mensagem.strip() and not args.arquivo:
+            logging.error(f"Arquivo de mensagem vazio: {args.mensagem_arquivo}")
+            return None
+    
+    selection = {
+        'roster_path': args.roster,
+        'setores': [setor.strip() for setor in args.setor],
+        'obras': [obra.strip() for obra in args.obra]
+    }
+    return {
+        'selecao': selection,
+        'comunicado_path': args.arquivo,
+        'mensagem': mensagem.strip() or None
+    }
+
+def resolve_selection(temp_data):
+    """
+    Resolve a seleção de destinatários contra a planilha de colaboradores
+    Apenas a contagem é feita antes do envio; os colaboradores são lidos sob demanda
+    Retorna (iterador de colaboradores, total) ou (None, 0) se a seleção for inválida
+    """
+    selection = temp_data['selecao']
+    try:
+        total = sum(1 for _ in iter_selection(selection))
+    except (ValueError, FileNotFoundError) as e:
+        logging.error(f"Erro ao resolver a seleção de destinatários: {e}")
+        return None, 0
+    
+    if total == 0:
+        logging.error("Nenhum colaborador corresponde à seleção informada.")
+        return None, 0
+    
+    return iter_selection(selection), total
+
+def find_partial_groups(temp_data, group_kind):
+    """
+    Compara os grupos da seleção com a planilha inteira
+    O envio por grupo chega a todos os participantes do grupo do WhatsApp, então uma
+    seleção com só parte da obra/setor atingiria colaboradores não selecionados
+    Retorna {nome do grupo: (selecionados, total na planilha)}
+    """
+    selection = temp_data.get('selecao')
+    if selection is None:
+        logging.warning("Dados sem referência à planilha: não foi possível verificar se os grupos foram selecionados inteiros")
+        return {}
+    index = RosterIndex.build(selection.get('roster_path') or ROSTER_PATH)
+    return index.partial_groups(group_kind, index.selection_rows(selection))
 
 def main():
     """Função principal"""
-    # Carregar dados temporários
-    try:
-        with open('temp_comunicado_data.json', 'r', encoding='utf-8') as f:
-            temp_data = json.load(f)
-    except FileNotFoundError:
-        logging.error("Arquivo de dados temporários não encontrado. Execute pelo app Streamlit.")
-        return
-    except Exception as e:
-        logging.error(f"Erro ao carregar dados temporários: {e}")
-        return
+    args = parse_args()
+    log_file = setup_logging()
+    
+    if args.roster:
+        # Modo headless: lê os destinatários diretamente da planilha
+        temp_data = load_headless_data(args)
+        if temp_data is None:
+            return
+    else:
+        # Carregar dados temporários
+        try:
+            with open('temp_comunicado_data.json', 'r', encoding='utf-8') as f:
+                temp_data = json.load(f)
+        except FileNotFoundError:
+            logging.error("Arquivo de dados temporários não encontrado. Execute pelo app Streamlit ou use --roster.")
+            return
+        except Exception as e:
+            logging.error(f"Erro ao carregar dados temporários: {e}")
+            return
     
     # Configurações da Evolution API (carregadas do .env)
     server_url = os.getenv("EVOLUTION_SERVER_URL")
@@ -411,21 +860,67 @@ def main():
         logging.error("Certifique-se de definir: EVOLUTION_SERVER_URL, EVOLUTION_API_KEY, EVOLUTION_INSTANCE_NAME")
         return
     
+    # Resolver a seleção de destinatários (seleção por referência à planilha)
+    if 'selecao' in temp_data:
+        colaboradores, total = resolve_selection(temp_data)
+        if colaboradores is None:
+            return
+    else:
+        colaboradores, total = temp_data['colaboradores'], None
+    
+    # Envio por grupo do WhatsApp (--grupo ou modo escolhido no app)
+    group_kind = args.grupo or temp_data.get('grupo')
+    group_map = load_group_map()[group_kind] if group_kind else None
+    
+    if group_kind and not (args.grupo_parcial or temp_data.get('grupo_parcial')):
+        partial_groups = find_partial_groups(temp_data, group_kind)
+        if partial_groups:
+            for group_name, (selected, group_total) in sorted(partial_groups.items()):
+                logging.error(f"{GROUP_FIELDS[group_kind]} {group_name or '(vazio)'}: {selected} de {group_total} colaboradores selecionados")
+            logging.error("O envio por grupo chega a todos os participantes de cada grupo. "
+                          "Selecione a obra/setor inteiro ou confirme o envio parcial (--grupo-parcial ou confirmação no app).")
+            return
+    
     # Criar instância do sender
-    sender = ComunicadosSenderEvolution(server_url, api_key, instance_name)
+    sender = ComunicadosSenderEvolution(
+        server_url, api_key, instance_name, load_retry_policies_from_env(),
+        force_resend=args.forcar_reenvio or temp_data.get('forcar_reenvio', False)
+    )
+    
+    # Profiling opcional (--profile ou opção marcada no app)
+    profiler = None
+    if args.profile or temp_data.get('profile'):
+        profiler = RunProfiler(log_file.replace('.log', '_profile.txt'))
+        profiler.instrument(sender, [
+            'process_employee', 'file_to_base64', '_post_message',
+            'check_instance_status', 'add_random_delay'
+        ])
+        profiler.instrument(sender.status_manager, [
+            '_save_status', 'update_employee_status', 'update_current_step'
+        ], prefix='StatusManager.')
+        profiler.start()
     
     # Executar envio
-    sender.send_comunicados_to_api(
-        temp_data['colaboradores'],
-        temp_data['comunicado_path'],
-        temp_data['mensagem']
-    )
+    try:
+        sender.send_comunicados_to_api(
+            colaboradores,
+            temp_data['comunicado_path'],
+            temp_data['mensagem'],
+            total,
+            group_kind=group_kind,
+            group_map=group_map,
+            personalize=args.personalizar or temp_data.get('personalizar', False)
+        )
+    finally:
+        if profiler:
+            profiler.stop()
     
     # Limpar arquivo temporário
-    try:
-        os.remove('temp_comunicado_data.json')
-    except:
-        pass
+    if not args.roster:
+        try:
+            os.remove('temp_comunicado_data.json')
+        except:
+            pass
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,65 @@
+import logging
+import os
+from datetime import datetime
+from typing import List
+import pandas as pd
+
+# Diretório dos relatórios de envio (CSV e Parquet), disponíveis para download no app
+REPORTS_DIR = "relatorios"
+
+
+class SendResult:
+    """Resultado final do envio para um colaborador"""
+
+    __slots__ = ("nome", "telefone", "setor", "obra", "status", "motivo", "timestamp")
+
+    def __init__(self, nome, telefone, setor, obra, status, motivo=""):
+        self.nome = nome
+        self.telefone = telefone
+        self.setor = setor
+        self.obra = obra
+        self.status = status
+        self.motivo = motivo
+        self.timestamp = datetime.now().isoformat(timespec="seconds")
+
+
+class SendResults:
+    """Resultados de uma execução, com contagem por status ('success', 'failed', 'skipped')"""
+
+    COLUMNS = SendResult.__slots__
+
+    def __init__(self):
+        self.records = []
+        self.counts = {"success": 0, "failed": 0, "skipped": 0}
+
+    def __len__(self):
+        return len(self.records)
+
+    def add(self, nome, telefone, setor, obra, status, motivo=""):
+        self.records.append(SendResult(nome, telefone, setor, obra, status, motivo))
+        self.counts[status] = self.counts.get(status, 0) + 1
+
+    def to_dataframe(self) -> pd.DataFrame:
+        """Monta a tabela de resultados numa única passagem"""
+        return pd.DataFrame.from_records(
+            ([getattr(record, column) for column in self.COLUMNS] for record in self.records),
+            columns=self.COLUMNS
+        )
+
+    def export(self, execution_id: str, reports_dir: str = REPORTS_DIR) -> List[str]:
+        """
+        Grava o relatório da execução em CSV e, se o pyarrow estiver instalado, em Parquet
+        Retorna os caminhos gravados
+        """
+        os.makedirs(reports_dir, exist_ok=True)
+        base_path = os.path.join(reports_dir, f"relatorio_{execution_id}")
+        df = self.to_dataframe()
+
+        paths = [base_path + ".csv"]
+        df.to_csv(paths[0], index=False, encoding="utf-8-sig")
+        try:
+            df.to_parquet(base_path + ".parquet", index=False)
+            paths.append(base_path + ".parquet")
+        except ImportError:
+            logging.warning("pyarrow não instalado: relatório gravado apenas em CSV")
+        return paths
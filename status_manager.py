@@ -1,16 +1,80 @@
 import json
 import os
 import threading
+import time
+from contextlib import contextmanager
 from datetime import datetime
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Set
+
+if os.name == "nt":
+    import msvcrt
+else:
+    import fcntl
+
+# Ordem dos níveis de confirmação de entrega
+DELIVERY_RANK = {"delivered": 1, "read": 2}
+
+# Campos por funcionário, omitidos do arquivo de resumo
+DETAIL_KEYS = ("employees_status", "message_index")
+
 
 class StatusManager:
     """Gerenciador de status para controle de execução e acompanhamento"""
     
     def __init__(self, status_file: str = "execution_status.json"):
         self.status_file = status_file
+        self.summary_file = os.path.splitext(status_file)[0] + ".summary.json"
+        self.lock_file = status_file + ".lock"
         self.lock = threading.Lock()
-        self._initialize_status()
+        # Snapshot do último status lido: (versão do arquivo, status)
+        self._snapshot = (None, None)
+        with self._exclusive():
+            self._initialize_status()
+    
+    @contextmanager
+    def _exclusive(self):
+        """
+        Trava para leitura-modificação-escrita do status, entre threads e entre processos
+        (app Streamlit, script de envio e receptor de webhooks usam o mesmo arquivo)
+        """
+        with self.lock:
+            with open(self.lock_file, "a+b") as lock_fd:
+                if os.name == "nt":
+                    lock_fd.seek(0)
+                    while True:
+                        try:
+                            msvcrt.locking(lock_fd.fileno(), msvcrt.LK_LOCK, 1)
+                            break
+                        except OSError:
+                            continue
+                    try:
+                        yield
+                    finally:
+                        lock_fd.seek(0)
+                        msvcrt.locking(lock_fd.fileno(), msvcrt.LK_UNLCK, 1)
+                else:
+                    fcntl.flock(lock_fd.fileno(), fcntl.LOCK_EX)
+                    try:
+                        yield
+                    finally:
+                        fcntl.flock(lock_fd.fileno(), fcntl.LOCK_UN)
+    
+    def _write_atomic(self, path: str, data: Dict, indent: Optional[int] = None):
+        """
+        Grava o JSON num arquivo temporário e o substitui de uma vez,
+        para que leitores nunca vejam um arquivo pela metade
+        """
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, indent=indent, ensure_ascii=False)
+        for _ in range(50):
+            try:
+                os.replace(temp_path, path)
+                return
+            except PermissionError:
+                # No Windows a substituição falha enquanto outro processo lê o arquivo
+                time.sleep(0.01)
+        os.replace(temp_path, path)
     
     def _initialize_status(self):
         """Inicializa o arquivo de status se não existir"""
@@ -24,8 +88,12 @@ class StatusManager:
                 "processed_employees": 0,
                 "successful_sends": 0,
                 "failed_sends": 0,
+                "skipped_sends": 0,
                 "current_employee": None,
                 "employees_status": {},
+                "message_index": {},
+                "delivered_count": 0,
+                "read_count": 0,
                 "last_update": None,
                 "execution_id": None
             }
@@ -41,17 +109,31 @@ class StatusManager:
             return self._load_status()
     
     def _save_status(self, status: Dict):
-        """Salva o status no arquivo"""
+        """Salva o status no arquivo e o resumo sem os dados por funcionário"""
         status["last_update"] = datetime.now().isoformat()
-        with open(self.status_file, 'w', encoding='utf-8') as f:
-            json.dump(status, f, indent=2, ensure_ascii=False)
+        self._write_atomic(self.status_file, status, indent=2)
+        
+        summary = {key: value for key, value in status.items() if key not in DETAIL_KEYS}
+        self._write_atomic(self.summary_file, summary)
+    
+    def file_version(self):
+        """
+        Versão do arquivo de status, ou None se não existir
+        Cada gravação substitui o arquivo (os.replace), então o inode muda a cada
+        gravação mesmo quando o mtime (de resolução grosseira) e o tamanho se repetem
+        """
+        try:
+            stat = os.stat(self.status_file)
+        except FileNotFoundError:
+            return None
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
     
     def start_execution(self, total_employees: int, execution_id: str = None) -> bool:
         """
         Inicia uma nova execução
         Retorna False se já houver uma execução em andamento
         """
-        with self.lock:
+        with self._exclusive():
             status = self._load_status()
             
             if status["is_running"]:
@@ -66,8 +148,12 @@ class StatusManager:
                 "processed_employees": 0,
                 "successful_sends": 0,
                 "failed_sends": 0,
+                "skipped_sends": 0,
                 "current_employee": None,
                 "employees_status": {},
+                "message_index": {},
+                "delivered_count": 0,
+                "read_count": 0,
                 "execution_id": execution_id or datetime.now().strftime("%Y%m%d_%H%M%S")
             })
             
@@ -76,7 +162,7 @@ class StatusManager:
     
     def end_execution(self):
         """Finaliza a execução atual"""
-        with self.lock:
+        with self._exclusive():
             status = self._load_status()
             status.update({
                 "is_running": False,
@@ -88,7 +174,7 @@ class StatusManager:
     
     def update_current_step(self, step: str, employee_name: str = None):
         """Atualiza o passo atual da execução"""
-        with self.lock:
+        with self._exclusive():
             status = self._load_status()
             status["current_step"] = step
             if employee_name:
@@ -96,49 +182,126 @@ class StatusManager:
             self._save_status(status)
     
     def update_employee_status(self, employee_id: str, employee_name: str, 
-                             phone: str, status_type: str, message: str = ""):
+                             phone: str, status_type: str, message: str = "",
+                             message_ids: Optional[List[str]] = None):
         """
         Atualiza o status de um funcionário específico
-        status_type: 'processing', 'success', 'failed'
+        status_type: 'processing', 'retrying', 'success', 'failed', 'skipped'
+        message_ids: IDs (key.id) das mensagens aceitas pela API, usados para
+        associar os recibos de entrega/leitura do webhook ao funcionário
         """
-        with self.lock:
+        with self._exclusive():
             status = self._load_status()
             
-            status["employees_status"][employee_id] = {
+            previous = status["employees_status"].get(employee_id, {})
+            employee_status = {
                 "name": employee_name,
                 "phone": phone,
                 "status": status_type,
                 "message": message,
-                "timestamp": datetime.now().isoformat()
+                "timestamp": datetime.now().isoformat(),
+                "message_ids": previous.get("message_ids", []),
+                "delivery": previous.get("delivery")
             }
+            status["employees_status"][employee_id] = employee_status
+            
+            if message_ids:
+                message_index = status.setdefault("message_index", {})
+                for message_id in message_ids:
+                    if message_id not in employee_status["message_ids"]:
+                        employee_status["message_ids"].append(message_id)
+                    message_index[message_id] = employee_id
             
             if status_type == "success":
                 status["successful_sends"] += 1
             elif status_type == "failed":
                 status["failed_sends"] += 1
+            elif status_type == "skipped":
+                status["skipped_sends"] = status.get("skipped_sends", 0) + 1
             
             status["processed_employees"] = len([
                 emp for emp in status["employees_status"].values() 
-                if emp["status"] in ["success", "failed"]
+                if emp["status"] in ["success", "failed", "skipped"]
             ])
             
             self._save_status(status)
     
+    def apply_delivery_updates(self, updates: Dict[str, str]) -> Set[str]:
+        """
+        Aplica em lote os recibos de entrega/leitura recebidos pelo webhook
+        updates: {message_id: 'delivered' | 'read'}
+        Retorna os IDs dos recibos associados a algum funcionário
+        """
+        with self._exclusive():
+            status = self._load_status()
+            message_index = status.get("message_index", {})
+            matched = set()
+            
+            for message_id, delivery in updates.items():
+                employee_id = message_index.get(message_id)
+                employee = status["employees_status"].get(employee_id)
+                if employee is None:
+                    continue
+                matched.add(message_id)
+                
+                current = employee.get("delivery")
+                if DELIVERY_RANK[delivery] <= DELIVERY_RANK.get(current, 0):
+                    continue
+                
+                # Conta cada funcionário uma vez por nível atingido
+                if current is None:
+                    status["delivered_count"] = status.get("delivered_count", 0) + 1
+                if delivery == "read":
+                    status["read_count"] = status.get("read_count", 0) + 1
+                employee["delivery"] = delivery
+            
+            if matched:
+                self._save_status(status)
+            return matched
+    
     def get_status(self) -> Dict:
-        """Retorna o status atual"""
-        return self._load_status()
+        """
+        Retorna o status atual
+        O status lido é reaproveitado enquanto o arquivo não mudar (inode/mtime/tamanho),
+        então várias chamadas no mesmo rerun do Streamlit fazem uma única leitura.
+        O dict retornado é compartilhado e não deve ser alterado.
+        """
+        snapshot_key, snapshot = self._snapshot
+        file_key = self.file_version()
+        if file_key is None or file_key != snapshot_key:
+            snapshot = self._load_status()
+            # Usa a versão obtida antes da leitura: se o arquivo for substituído
+            # durante a leitura, a próxima chamada vê outra versão e lê de novo
+            self._snapshot = (file_key, snapshot)
+        return snapshot
+    
+    def get_summary(self) -> Dict:
+        """
+        Retorna apenas os contadores e o estado da execução, sem carregar
+        os dados por funcionário (employees_status)
+        """
+        try:
+            with open(self.summary_file, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            status = self.get_status()
+            return {key: value for key, value in status.items() if key not in DETAIL_KEYS}
     
     def is_running(self) -> bool:
         """Verifica se há uma execução em andamento"""
-        return self._load_status()["is_running"]
+        return self.get_summary()["is_running"]
     
-    def get_progress_percentage(self) -> float:
-        """Retorna a porcentagem de progresso"""
-        status = self._load_status()
+    @staticmethod
+    def progress_of(status: Dict) -> float:
+        """Calcula a porcentagem de progresso de um status ou resumo já carregado"""
         if status["total_employees"] == 0:
             return 0.0
         return (status["processed_employees"] / status["total_employees"]) * 100
     
+    def get_progress_percentage(self) -> float:
+        """Retorna a porcentagem de progresso"""
+        return self.progress_of(self.get_summary())
+    
     def get_employees_by_status(self, status_type: str) -> List[Dict]:
         """Retorna lista de funcionários por status"""
         status = self._load_status()
@@ -149,7 +312,8 @@ class StatusManager:
     
     def reset_status(self):
         """Reseta o status para o estado inicial"""
-        with self.lock:
-            if os.path.exists(self.status_file):
-                os.remove(self.status_file)
+        with self._exclusive():
+            for path in (self.status_file, self.summary_file):
+                if os.path.exists(path):
+                    os.remove(path)
             self._initialize_status()
\ No newline at end of file
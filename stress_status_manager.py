@@ -0,0 +1,180 @@
+"""
+Teste de carga e concorrência do StatusManager
+
+Simula o uso em produção: vários processos gravando atualizações de status
+(script de envio, receptor de webhooks) enquanto outros leem o status (app Streamlit).
+Mede a vazão das atualizações e a latência das leituras, e verifica que nenhuma
+atualização foi perdida ou corrompida.
+
+As leituras que devolvem o mesmo objeto da leitura anterior (snapshot em cache,
+arquivo inalterado) são contadas à parte: a latência de leitura comparável entre
+backends é a das leituras que de fato carregaram o status.
+
+Uso:
+    python stress_status_manager.py
+    python stress_status_manager.py --writers 4 --readers 4 --updates 500
+    python stress_status_manager.py --backend meu_modulo:OutroStatusManager
+
+O backend deve ter a mesma interface do StatusManager (construtor recebendo o
+caminho do arquivo, reset_status, start_execution, update_employee_status, get_status).
+Retorna código de saída 1 se alguma verificação falhar.
+"""
+import argparse
+import importlib
+import multiprocessing
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+
+def load_backend(spec: str):
+    """Carrega a classe do backend a partir de 'modulo:Classe'"""
+    module_name, class_name = spec.split(":")
+    return getattr(importlib.import_module(module_name), class_name)
+
+
+def writer(backend_spec, status_file, writer_id, updates, results):
+    """Grava 'updates' atualizações de status, uma por funcionário"""
+    manager = load_backend(backend_spec)(status_file)
+    latencies = []
+    errors = 0
+    for index in range(updates):
+        employee_id = f"w{writer_id}_{index}"
+        start = time.perf_counter()
+        try:
+            manager.update_employee_status(employee_id, employee_id, "5511999999999", "success", "ok")
+        except Exception:
+            errors += 1
+        latencies.append(time.perf_counter() - start)
+    results.put(("writer", latencies, errors, 0, 0))
+
+
+def reader(backend_spec, status_file, stop_event, results):
+    """Lê o status continuamente, verificando que o progresso nunca regride"""
+    manager = load_backend(backend_spec)(status_file)
+    latencies = []
+    cache_hits = 0
+    errors = 0
+    regressions = 0
+    last_processed = 0
+    status = None
+    while not stop_event.is_set():
+        start = time.perf_counter()
+        try:
+            previous, status = status, manager.get_status()
+        except Exception:
+            errors += 1
+            continue
+        elapsed = time.perf_counter() - start
+        if status is previous:
+            cache_hits += 1
+        else:
+            latencies.append(elapsed)
+        # Progresso menor que o já lido indica status reinicializado ou atualização perdida
+        if status["processed_employees"] < last_processed:
+            regressions += 1
+        last_processed = max(last_processed, status["processed_employees"])
+    results.put(("reader", latencies, errors, regressions, cache_hits))
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Teste de carga e concorrência do StatusManager")
+    parser.add_argument("--backend", default="status_manager:StatusManager", help="Backend no formato modulo:Classe")
+    parser.add_argument("--writers", type=int, default=4, help="Processos gravando atualizações")
+    parser.add_argument("--readers", type=int, default=2, help="Processos lendo o status")
+    parser.add_argument("--updates", type=int, default=200, help="Atualizações por processo gravador")
+    args = parser.parse_args()
+
+    temp_dir = tempfile.mkdtemp(prefix="stress_status_")
+    try:
+        return run(args, os.path.join(temp_dir, "status.json"))
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+def run(args, status_file):
+    """Executa o teste sobre o arquivo de status informado e retorna o código de saída"""
+    backend = load_backend(args.backend)
+    manager = backend(status_file)
+    manager.reset_status()
+    expected = args.writers * args.updates
+    manager.start_execution(expected, "stress")
+
+    results = multiprocessing.Queue()
+    stop_event = multiprocessing.Event()
+    readers = [
+        multiprocessing.Process(target=reader, args=(args.backend, status_file, stop_event, results))
+        for _ in range(args.readers)
+    ]
+    writers = [
+        multiprocessing.Process(target=writer, args=(args.backend, status_file, writer_id, args.updates, results))
+        for writer_id in range(args.writers)
+    ]
+
+    for process in readers:
+        process.start()
+    start = time.perf_counter()
+    for process in writers:
+        process.start()
+
+    # Os resultados são coletados antes do join para não travar na fila cheia
+    collected = [results.get() for _ in writers]
+    elapsed = time.perf_counter() - start
+    stop_event.set()
+    collected += [results.get() for _ in readers]
+    for process in writers + readers:
+        process.join()
+
+    write_latencies, read_latencies = [], []
+    write_errors = read_errors = regressions = cache_hits = 0
+    for kind, latencies, errors, regressed, hits in collected:
+        if kind == "writer":
+            write_latencies += latencies
+            write_errors += errors
+        else:
+            read_latencies += latencies
+            read_errors += errors
+            regressions += regressed
+            cache_hits += hits
+
+    final = backend(status_file).get_status()
+    checks = {
+        "todas as atualizações gravadas": len(final["employees_status"]) == expected,
+        "contador de sucessos correto": final["successful_sends"] == expected,
+        "contador de processados correto": final["processed_employees"] == expected,
+        "nenhum erro de gravação": write_errors == 0,
+        "nenhum erro de leitura": read_errors == 0,
+        "progresso nunca regrediu nas leituras": regressions == 0,
+    }
+
+    print(f"Backend: {args.backend}")
+    print(f"Processos: {args.writers} gravando x {args.updates} atualizações, {args.readers} lendo")
+    print(f"Vazão de atualizações: {expected / elapsed:.1f}/s ({elapsed:.2f} s no total)")
+    if write_latencies:
+        print(f"Latência de gravação: mediana {statistics.median(write_latencies) * 1000:.2f} ms, "
+              f"p95 {percentile(write_latencies, 0.95) * 1000:.2f} ms, máx {max(write_latencies) * 1000:.2f} ms")
+    print(f"Leituras: {len(read_latencies)} carregaram o status, {cache_hits} reaproveitaram o snapshot em cache")
+    if read_latencies:
+        print(f"Latência de leitura (carregando o status): mediana {statistics.median(read_latencies) * 1000:.2f} ms, "
+              f"p95 {percentile(read_latencies, 0.95) * 1000:.2f} ms, máx {max(read_latencies) * 1000:.2f} ms")
+    print(f"Status final: {len(final['employees_status'])}/{expected} funcionários, "
+          f"{final['successful_sends']} sucessos, {final['processed_employees']} processados")
+    print()
+    for description, passed in checks.items():
+        print(f"{'✅' if passed else '❌'} {description}")
+
+    return 0 if all(checks.values()) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
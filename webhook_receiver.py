@@ -0,0 +1,234 @@
+import argparse
+import hmac
+import json
+import logging
+import os
+import queue
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+from urllib.parse import parse_qs, urlsplit
+from dotenv import load_dotenv
+from status_manager import StatusManager, DELIVERY_RANK
+
+# Carrega as variáveis do arquivo .env
+load_dotenv()
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(levelname)s - %(message)s",
+    handlers=[logging.StreamHandler(sys.stdout)]
+)
+
+# Status de mensagem da Evolution API -> nível de confirmação
+# (v2 envia o nome do status; versões antigas enviam o código numérico)
+RECEIPT_STATUS_MAP = {
+    "DELIVERY_ACK": "delivered",
+    "READ": "read",
+    "PLAYED": "read",
+    3: "delivered",
+    4: "read",
+    5: "read",
+}
+
+
+def extract_receipts(payload):
+    """
+    Extrai pares (message_id, nível) de um evento messages.update da Evolution API
+    Aceita 'data' como objeto único ou lista de atualizações
+    """
+    data = payload.get("data", payload) if isinstance(payload, dict) else payload
+    updates = data if isinstance(data, list) else [data]
+
+    for update in updates:
+        if not isinstance(update, dict):
+            continue
+        message_id = update.get("keyId") or update.get("key", {}).get("id")
+        raw_status = update.get("status", update.get("update", {}).get("status"))
+        delivery = RECEIPT_STATUS_MAP.get(raw_status)
+        if message_id and delivery:
+            yield message_id, delivery
+
+
+class ReceiptBuffer:
+    """
+    Armazena os recibos recebidos e os grava em lote no StatusManager,
+    para que o recebimento HTTP nunca espere pela escrita em disco
+    """
+
+    def __init__(self, status_manager: StatusManager, batch_size: int = 1000,
+                 flush_interval: float = 2.0, pending_ttl: float = 600):
+        """
+        Args:
+            status_manager: Gerenciador de status onde os recibos são gravados
+            batch_size: Máximo de recibos por gravação
+            flush_interval: Intervalo máximo em segundos entre gravações
+            pending_ttl: Por quanto tempo (segundos) um recibo ainda sem colaborador
+                         é guardado e tentado novamente. O recibo pode chegar antes
+                         de o script de envio gravar o ID da mensagem; recibos de
+                         conversas que não são comunicados expiram após esse tempo
+        """
+        self.status_manager = status_manager
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.pending_ttl = pending_ttl
+        # Recibos ainda não associados: message_id -> (nível, instante em que expira)
+        self._pending = {}
+        # Versão do arquivo de status na última tentativa de associar os pendentes
+        self._pending_checked_version = None
+        self._queue = queue.Queue()
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._flush_loop, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def put(self, message_id: str, delivery: str):
+        self._queue.put((message_id, delivery))
+
+    def stop(self):
+        """Encerra o buffer gravando os recibos pendentes"""
+        self._stop_event.set()
+        self._thread.join()
+
+    def _flush_loop(self):
+        while not self._stop_event.is_set() or not self._queue.empty():
+            batch = {}
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    message_id, delivery = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                # Mantém apenas o nível mais alto por mensagem dentro do lote
+                if DELIVERY_RANK[delivery] > DELIVERY_RANK.get(batch.get(message_id), 0):
+                    batch[message_id] = delivery
+
+            if batch or self._pending:
+                self._flush(batch)
+
+    def _flush(self, batch):
+        """Grava o lote junto com os recibos pendentes; os não associados voltam para os pendentes"""
+        now = time.monotonic()
+        self._pending = {
+            message_id: pending for message_id, pending in self._pending.items()
+            if pending[1] > now
+        }
+        updates = {message_id: delivery for message_id, (delivery, _) in self._pending.items()}
+        for message_id, delivery in batch.items():
+            if DELIVERY_RANK[delivery] > DELIVERY_RANK.get(updates.get(message_id), 0):
+                updates[message_id] = delivery
+        if not updates:
+            return
+
+        # Recibos de conversas comuns da instância nunca são associados: só tenta de novo
+        # quando o status mudou (IDs novos gravados pelo envio) ou quando chegaram recibos novos,
+        # para não recarregar o status inteiro sob a trava a cada intervalo
+        version = self.status_manager.file_version()
+        has_new_ids = any(message_id not in self._pending for message_id in batch)
+        if not has_new_ids and version == self._pending_checked_version:
+            for message_id, delivery in batch.items():
+                self._pending[message_id] = (updates[message_id], self._pending[message_id][1])
+            return
+        # Versão lida antes da gravação: uma alteração feita durante a gravação gera nova tentativa
+        self._pending_checked_version = version
+
+        try:
+            matched = self.status_manager.apply_delivery_updates(updates)
+        except Exception as e:
+            logging.error(f"Erro ao gravar recibos de entrega: {e}")
+            matched = set()
+
+        for message_id, delivery in updates.items():
+            if message_id in matched:
+                self._pending.pop(message_id, None)
+            else:
+                expires_at = self._pending.get(message_id, (None, now + self.pending_ttl))[1]
+                self._pending[message_id] = (delivery, expires_at)
+
+        if batch or matched:
+            logging.info(f"{len(batch)} recibo(s) recebido(s), {len(matched)} associado(s) a colaboradores, "
+                         f"{len(self._pending)} aguardando o ID da mensagem")
+
+
+def make_handler(buffer: ReceiptBuffer, token: Optional[str] = None):
+    """
+    Cria o handler HTTP que repassa os eventos do webhook para o buffer
+    Com token, só aceita requisições com o cabeçalho 'Authorization: Bearer <token>'
+    (configurado nos headers do webhook da Evolution API) ou com '?token=<token>' na URL
+    """
+
+    class WebhookHandler(BaseHTTPRequestHandler):
+        def _authorized(self) -> bool:
+            if not token:
+                return True
+            authorization = self.headers.get("Authorization", "")
+            received = authorization[len("Bearer "):] if authorization.startswith("Bearer ") else ""
+            if not received:
+                received = parse_qs(urlsplit(self.path).query).get("token", [""])[0]
+            return hmac.compare_digest(received.encode("utf-8"), token.encode("utf-8"))
+
+        def do_POST(self):
+            if not self._authorized():
+                self.send_response(401)
+                self.end_headers()
+                return
+
+            length = int(self.headers.get("Content-Length", 0))
+            try:
+                payload = json.loads(self.rfile.read(length) or b"{}")
+            except json.JSONDecodeError:
+                self.send_response(400)
+                self.end_headers()
+                return
+
+            for message_id, delivery in extract_receipts(payload):
+                buffer.put(message_id, delivery)
+
+            self.send_response(200)
+            self.end_headers()
+
+        def log_message(self, format, *args):
+            # Evita um log por requisição em picos de milhares de eventos
+            pass
+
+    return WebhookHandler
+
+
+def main():
+    """Inicia o receptor de webhooks de entrega/leitura"""
+    parser = argparse.ArgumentParser(description="Receptor de recibos de entrega/leitura da Evolution API")
+    parser.add_argument("--host", default=os.getenv("WEBHOOK_HOST", "127.0.0.1"))
+    parser.add_argument("--port", type=int, default=int(os.getenv("WEBHOOK_PORT", 8085)))
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--flush-interval", type=float, default=2.0)
+    args = parser.parse_args()
+
+    # Sem token, qualquer um na rede poderia forjar recibos de leitura
+    token = os.getenv("WEBHOOK_TOKEN")
+    if not token and args.host not in ("127.0.0.1", "localhost", "::1"):
+        logging.error(f"Defina WEBHOOK_TOKEN para escutar em {args.host} (fora da máquina local)")
+        sys.exit(1)
+
+    buffer = ReceiptBuffer(StatusManager("comunicados_status.json"), args.batch_size, args.flush_interval)
+    buffer.start()
+
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(buffer, token))
+    logging.info(f"Receptor de webhooks escutando em http://{args.host}:{args.port}")
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logging.info("Encerrando receptor de webhooks")
+    finally:
+        server.server_close()
+        buffer.stop()
+
+
+if __name__ == "__main__":
+    main()
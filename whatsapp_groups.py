@@ -0,0 +1,22 @@
+import json
+import os
+from typing import Dict
+from roster_store import clean_cell
+
+# Mapeamento de Obra/Setor para o JID do grupo do WhatsApp, ex:
+# {"obra": {"Obra A": "120363012345678901@g.us"}, "setor": {"Operacional": "120363...@g.us"}}
+GROUPS_FILE = "grupos_whatsapp.json"
+
+# Campo da planilha usado em cada modo de envio por grupo
+GROUP_FIELDS = {"obra": "Obra", "setor": "Setor"}
+
+
+def load_group_map(path: str = GROUPS_FILE) -> Dict[str, Dict[str, str]]:
+    """Carrega o mapeamento de grupos; retorna mapeamentos vazios se o arquivo não existir"""
+    group_map = {"obra": {}, "setor": {}}
+    if os.path.exists(path):
+        with open(path, 'r', encoding='utf-8') as f:
+            loaded = json.load(f)
+        for kind in group_map:
+            group_map[kind].update({clean_cell(name): jid for name, jid in loaded.get(kind, {}).items()})
+    return group_map